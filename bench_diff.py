@@ -0,0 +1,87 @@
+#!/usr/bin/python
+'''\
+Micro-benchmark of the "what is new" diff (see diff_engine), for stocks.
+
+Usage: {0} [rows ..]    (default: 10000 100000 1000000)
+
+Half of the Oracle rows name a stock, Chado knows already, and every tenth
+row repeats an earlier one. The old list based diff is only run up to
+OLD_MAX rows, as it is quadratic.\
+'''
+import utility # must be first cause of monkey-patching
+import sys
+import time
+from collections import namedtuple
+import diff_engine
+from task_storage import TaskStorage
+
+OLD_MAX = 10000
+
+Row = namedtuple('Row', ['NAME', 'VALUE'])
+Stock = namedtuple('Stock', ['stock_id', 'uniquename'])
+
+def make_data(n):
+    rows = []
+    for i in range(n):
+        if i % 10 == 9:
+            rows.append(rows[i // 2])
+        else:
+            rows.append(Row('stock {}'.format(i), i))
+    chads = [Stock(i, 'stock {}'.format(i)) for i in range(0, n, 2)]
+    return rows, chads
+
+def old_diff(rows, chads):
+    '''The list based diff, we had before.'''
+    TaskStorage.known_stock_ids = []
+    TaskStorage.unknown_stocks = []
+    def f2(ora, chads):
+        for c in chads:
+            if ora.NAME == c.uniquename:
+                TaskStorage.known_stock_ids.append(c.stock_id)
+                return True
+        if ora.NAME in TaskStorage.unknown_stocks:
+            index = TaskStorage.unknown_stocks.index(ora.NAME)
+            TaskStorage.known_stock_ids.append(utility.Duplicate(index))
+        else:
+            TaskStorage.unknown_stocks.append(ora.NAME)
+            TaskStorage.known_stock_ids.append(None)
+        return False
+    unknown = []
+    for entry in rows:
+        if not f2(entry, chads) and not entry in unknown:
+            unknown.append(entry)
+    return unknown
+
+def new_diff(rows, chads):
+    is_in = diff_engine.StockMembership('NAME')
+    return diff_engine.unknown_rows(rows, rows, is_in, chads)
+
+def timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return time.time() - start, result
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [10000, 100000, 1000000]
+    print '{0:>9} {1:>10} {2:>10} {3:>8}'.format('rows', 'old [s]', 'new [s]',
+                                                 'unknown')
+    for n in sizes:
+        rows, chads = make_data(n)
+        t_new, new = timed(new_diff, rows, chads)
+        ids_new = TaskStorage.known_stock_ids
+        t_old = '-'
+        if n <= OLD_MAX:
+            t_old, old = timed(old_diff, rows, chads)
+            ids_old = TaskStorage.known_stock_ids
+            assert old == new
+            assert [getattr(i, 'index', i) for i in ids_old]\
+                == [getattr(i, 'index', i) for i in ids_new]
+            t_old = '{0:.3f}'.format(t_old)
+        print '{0:>9} {1:>10} {2:>10.3f} {3:>8}'.format(n, t_old, t_new,
+                                                        len(new))
+
+if __name__ == '__main__':
+    if '-h' in sys.argv or '--help' in sys.argv:
+        print __doc__.format(sys.argv[0])
+        exit(0)
+    main()
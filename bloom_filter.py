@@ -0,0 +1,60 @@
+'''
+A plain Bloom filter of strings, see chado_index.BloomIndex.
+
+It answers "might be in the set" with a false positive rate of about
+<error_rate>, as long as it holds at most <capacity> items, and never gives
+false negatives. It takes about 10 bits per item at 1%, instead of the
+whole strings.
+'''
+import math
+import struct
+from hashlib import md5
+
+class BloomFilter(object):
+    '''Usage:
+        f = BloomFilter(1000000, 0.01)
+        f.add('foo')
+        'foo' in f      # -> True
+        'bar' in f      # -> False, or with a chance of 1% True
+    Instances pickle to their bits, so they can be saved between runs.
+    '''
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(int(capacity), 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        ln2 = math.log(2)
+        self.m = int(math.ceil(-capacity * math.log(error_rate) / ln2**2))
+        self.k = max(int(round(self.m / float(capacity) * ln2)), 1)
+        self.bits = bytearray((self.m + 7) // 8)
+        self.count = 0
+
+    def __positions(self, item):
+        '''The k bit positions of <item>, by double hashing one md5.'''
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', md5(item).digest())
+        m = self.m
+        return [(h1 + i * h2) % m for i in xrange(self.k)]
+
+    def add(self, item):
+        bits = self.bits
+        for p in self.__positions(item):
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        bits = self.bits
+        for p in self.__positions(item):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def full(self):
+        '''True, once we hold more than <capacity> items, and the false
+        positive rate exceeds <error_rate>.'''
+        return self.count > self.capacity
@@ -4,11 +4,19 @@ Cassava Phenotyping Ontology
 We need to know this for translating the columns to their chado equivalent.
 '''
 
+import time
+import cPickle
 from collections import namedtuple
 from utility import OracleSQLQueries as OSQLQ
 import utility
+import column_cache
+import local_store
 
-# TODO remove this, and use utility.make_namedtuple_with_query
+# Seconds, we trust the cached ontology views without reading them again, as
+# long as their row counts did not change. 0 disables the cache.
+ONTOLOGY_TTL = 24 * 3600
+
+# TODO remove this, and use utility.make_namedtuple_with_headers
 def get_tabledata_as_tuple(cursor, table):
     '''Create a list of namedtuple's for <table> with <column_names> as
     members.
@@ -17,16 +25,48 @@ def get_tabledata_as_tuple(cursor, table):
         cursor      a PEP 249 compliant cursor pointing to the oracledb
         table       name of the table
     '''
-    sql = OSQLQ.get_column_metadata_from.format(table=table)
-    cursor.execute(sql)
-    column_names = [line[1] for line in cursor.fetchall()]
+    column_names, rows = fetch_table(cursor, table)
+    return make_tuples(column_names, rows)
 
-    VOntology = namedtuple('VOntology', column_names)
-    sql = OSQLQ.get_all_from.format(table=table)
-    cursor.execute(sql)
-    vonto = [VOntology(*line) for line in cursor.fetchall()]
+def fetch_table(cursor, table):
+    '''Returns the column names and all rows of <table>.'''
+    column_names = column_cache.shared().columns(cursor, table)
+    cursor.execute(OSQLQ.get_all_from.format(table=table))
+    return column_names, cursor.fetchall()
 
-    return vonto
+def make_tuples(column_names, rows):
+    VOntology = namedtuple('VOntology', column_names)
+    return [VOntology(*line) for line in rows]
+
+def row_counts(cursor, tables):
+    '''Returns the number of rows of each of <tables>, in a single query.'''
+    counts = ', '.join(OSQLQ.get_row_count.format(table=t) for t in tables)
+    cursor.execute(OSQLQ.select_from_dual.format(columns=counts))
+    return list(cursor.fetchone())
+
+def load_tables(cursor, tables, ttl=ONTOLOGY_TTL):
+    '''Returns [(column names, rows), ..] of <tables>, read from a local
+    cache, if that is younger than <ttl> seconds, and the row counts match.
+    Otherwise we read the tables and renew the cache.'''
+    if not ttl:
+        return [fetch_table(cursor, t) for t in tables]
+    store = local_store.LocalStore('ontology')
+    key = tuple(tables)
+    cached = store.get(key)
+    if cached and time.time() - cached['time'] < ttl:
+        if cached['counts'] == row_counts(cursor, tables):
+            return cached['tables']
+    data = [fetch_table(cursor, t) for t in tables]
+    store[key] = {
+        'time' : time.time(),
+        'counts' : [len(rows) for names,rows in data],
+        'tables' : data,
+    }
+    try:
+        store.save()
+    except (cPickle.PicklingError, TypeError) as e:
+        print '[cassava_ontology] not caching the ontology: {}'.format(e)
+    return data
 
 class CassavaOntology():
     '''Ontology for the Cassava plant, in spanish and english.
@@ -41,33 +81,47 @@ class CassavaOntology():
         onto        English ontology (+cvterm meta info)
         mapping     Mapping of the spanish ontology names to a list of all
                     corresponding cvterms as VOntology() objects.
+        by_trait    Mapping of the lower case TRAIT_NAMEs to the first
+                    VOntology() of each mapping entry with that name, see
+                    find_traits().
     '''
 
     SPANISH_ONTOLOGY_TABLE = 'V_ONTOLOGY_SPANISH'
     ONTOLOGY_TABLE = 'V_ONTOLOGY'
 
-    def __init__(self, cursor):
-        '''We need that cursor to the db holding chado.'''
+    def __init__(self, cursor, ttl=ONTOLOGY_TTL):
+        '''We need that cursor to the db holding chado. The views are cached
+        locally for <ttl> seconds, see load_tables().'''
         self.c = cursor
-        self.onto_sp = get_tabledata_as_tuple(self.c,
-            self.SPANISH_ONTOLOGY_TABLE)
-        self.onto = get_tabledata_as_tuple(self.c, self.ONTOLOGY_TABLE)
+        tables = [self.SPANISH_ONTOLOGY_TABLE, self.ONTOLOGY_TABLE]
+        sp, en = load_tables(self.c, tables, ttl=ttl)
+        self.onto_sp = make_tuples(*sp)
+        self.onto = make_tuples(*en)
 
         # Get all corresponding cvterm info for the spanish names
-        tmp_map = [[i for i in self.onto \
-            if i.VARIABLE_ID == j.VARIABLE_ID_BMS] for j in self.onto_sp]
+        by_variable = {}
+        for i in self.onto:
+            by_variable.setdefault(i.VARIABLE_ID, []).append(i)
 
         self.mapping = {}
-        to_remove = []
-
-        for key,value in zip(self.onto_sp, tmp_map):
-            if len(value) == 0:
-                # we did not find a mapping, so this cvterm is unusable
-                to_remove.append(key)
-            else:
-                self.mapping[key.SPANISH.upper()] = value
-        for term in to_remove:
-            self.onto_sp.remove(term)
+        usable = []
+        for term in self.onto_sp:
+            value = by_variable.get(term.VARIABLE_ID_BMS)
+            if value:
+                self.mapping[term.SPANISH.upper()] = value
+                usable.append(term)
+            # else we did not find a mapping, so this cvterm is unusable
+        self.onto_sp = usable
+
+        self.by_trait = {}
+        for value in self.mapping.itervalues():
+            key = value[0].TRAIT_NAME.lower()
+            self.by_trait.setdefault(key, []).append(value[0])
+
+    def find_traits(self, name):
+        '''Returns the VOntology()s, whose TRAIT_NAME equals <name>, ignoring
+        the case.'''
+        return self.by_trait.get(name.lower(), [])
 
     def get_ontologies(self):
         '''Returns the two named tuples, with the Ontology data.'''
@@ -554,8 +554,11 @@ class ChadoDataLinker(object):
         return [t,]
 
     def __strip_0time(self, ps):
-        '''strip time from datetime stockprops'''
+        '''strip time from datetime stockprops, Oracledb usually gives us
+        date strings already'''
         for p in ps:
+            if type(p[1]) is str:
+                continue
             if hasattr(p[1], 'date'):
                 if callable(p[1].date):
                     p[1] = p[1].date()
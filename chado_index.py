@@ -0,0 +1,365 @@
+'''
+Run-scoped index of what already exists in Chado.
+
+TableGuru needs to know, which stocks, stockprops and phenotypes are in
+Chado, to upload only new ones. Instead of reading those whole tables every
+round, we read them once per create_upload_tasks(), and after each upload
+round, only the rows with ids above the highest one we have seen, see
+ChadoIndex.refresh().
+
+For large Chado instances StagedIndex keeps nothing but the current round's
+keys in memory, and lets Postgres find out which of them exist, and
+BloomIndex keeps the phenotype uniquenames, by far the most keys, in a Bloom
+filter only, see DIFF_MODES.
+'''
+import os
+import itertools
+from hashlib import md5
+from StringIO import StringIO
+import utility
+import local_store
+from bloom_filter import BloomFilter
+from utility import PostgreSQLQueries as PSQLQ
+
+# client: ChadoIndex, all of Chado's keys in memory
+# server: StagedIndex, the round's keys are staged in Postgres and anti-joined
+# bloom:  BloomIndex, like client, but phenotypes only in a Bloom filter
+DIFF_MODES = ['client', 'server', 'bloom']
+# BloomIndex: false positive rate, and room for growth of the filter
+BLOOM_ERROR_RATE = 0.01
+BLOOM_GROWTH = 2
+# phenotype uniquenames per query/fetch
+BLOOM_BATCH = 10000
+
+class ChadoIndex(object):
+    '''Usage:
+        idx = ChadoIndex(chado)
+        idx.load()
+        idx.stock_ids['some uniquename']  # -> stock_id
+        ..  # upload
+        idx.refresh()
+
+    Attributes:
+        stock_ids       stock.uniquename -> stock_id
+        stock_names     stock.name -> stock_id
+        stockprops      set((stock_id, type_id), ..)
+        stockprop_types cvterm.name -> cvterm_id, of all stockprop types, or
+                        only those given to load()
+        phenotypes      set(phenotype.uniquename, ..)
+
+    Note that we don't notice deletions, nor rows others insert with lower
+    ids meanwhile.
+
+    If STAGED, stage() must be called with the keys of each round, before
+    diffing it.
+    '''
+    STAGED = False
+
+    def __init__(self, chado):
+        self.chado = chado
+        self.max_ids = {}
+        self.prop_types = None
+        self.type_names = {} # cvterm_id -> cvterm.name, of seen stockprop types
+
+    def load(self, prop_types=None):
+        '''(Re-)Read everything. If <prop_types> is given, only the
+        stockprops and stockprop types with those names are read.'''
+        self.stock_ids = {}
+        self.stock_names = {}
+        self.stockprops = set()
+        self.stockprop_types = {}
+        self.type_names = {}
+        self.phenotypes = set()
+        self.max_ids = {'stock' : 0, 'stockprop' : 0, 'phenotype' : 0}
+        self.prop_types = None
+        if prop_types is not None:
+            self.prop_types = set(prop_types)
+            self.__load_stockprops()
+        self.refresh()
+
+    def __load_stockprops(self):
+        '''Reads the distinct (stock_id, type_id) pairs of the wanted
+        stockprop types only, instead of every stockprop row.'''
+        c = self.chado.con.cursor()
+        # first, so refresh() picks up whatever is inserted meanwhile
+        c.execute(PSQLQ.select_max_id.format(table='stockprop',
+                                             id='stockprop_id'))
+        self.max_ids['stockprop'] = c.fetchone()[0]
+        if self.prop_types:
+            c.execute(PSQLQ.stockprop_types, (list(self.prop_types),))
+            self.stockprop_types = dict(c.fetchall())
+            self.type_names = utility.invert_dict(self.stockprop_types)
+        if self.type_names:
+            ids = ', '.join(str(t) for t in self.type_names)
+            c.execute(PSQLQ.stockprop_pairs.format(ids=ids))
+            self.stockprops = set(c.fetchall())
+        c.close()
+
+    def __new_rows(self, cursor, table, columns):
+        '''Returns the <columns> of all rows of <table>, with an id above the
+        one we have seen last. The id is prepended to <columns>.'''
+        id_col = table + '_id'
+        sql = PSQLQ.select_above_id.format(table=table, id=id_col,
+                                           columns=id_col + ', ' + columns,
+                                           max=self.max_ids[table])
+        cursor.execute(sql)
+        rows = cursor.fetchall()
+        if rows:
+            self.max_ids[table] = max(r[0] for r in rows)
+        return rows
+
+    def refresh(self):
+        '''Adds what was uploaded since the last load() or refresh().'''
+        c = self.chado.con.cursor()
+
+        for stock_id, name, uniquename in self.__new_rows(c, 'stock',
+                                                          'name, uniquename'):
+            self.stock_ids.setdefault(uniquename, stock_id)
+            self.stock_names[name] = stock_id
+
+        pairs = set((s,t) for _,s,t in self.__new_rows(c, 'stockprop',
+                                                       'stock_id, type_id'))
+        types = set(t for s,t in pairs).difference(self.type_names)
+        if types:
+            ids = ', '.join(str(t) for t in types)
+            c.execute(PSQLQ.select_cvterm_names.format(ids=ids))
+            self.type_names.update(c.fetchall())
+        for stock_id, type_id in pairs:
+            name = self.type_names.get(type_id)
+            if self.prop_types is not None and not name in self.prop_types:
+                continue
+            self.stockprops.add((stock_id, type_id))
+            if name is not None:
+                self.stockprop_types[name] = type_id
+
+        self.add_phenotypes(u for _,u in self.__new_rows(c, 'phenotype',
+                                                         'uniquename'))
+
+        c.close()
+
+    def add_phenotypes(self, uniquenames):
+        self.phenotypes.update(uniquenames)
+
+    def stage(self, stock_names, pheno_uniquenames, prop_types):
+        '''Called with the keys of each round before diffing it, we know
+        them all already.'''
+        pass
+
+    def close(self):
+        pass
+
+def _copy_rows(values):
+    '''One value per line, escaped for COPY .. FROM.'''
+    def esc(v):
+        return v.replace('\\', '\\\\').replace('\t', '\\t')\
+                .replace('\n', '\\n').replace('\r', '\\r')
+    return StringIO('\n'.join(esc(str(v)) for v in values))
+
+class StagedIndex(ChadoIndex):
+    '''Like ChadoIndex, but the attributes only hold what exists in Chado,
+    of the keys given to the last stage() call.
+
+    We COPY those keys into TEMP staging tables (no WAL, and dropped with
+    the session, should close() not be reached), and join them with
+    stock.uniquename, stock.name and phenotype.uniquename, so Postgres uses
+    its indexes, and we never load whole Chado tables.
+    '''
+    STAGED = True
+    _counter = itertools.count()
+
+    def __init__(self, chado):
+        super(StagedIndex, self).__init__(chado)
+        # one pair of staging tables per instance and process
+        suffix = '{0}_{1}'.format(os.getpid(), next(self._counter))
+        self.stage_stock = 'mtods_stage_stock_' + suffix
+        self.stage_pheno = 'mtods_stage_phenotype_' + suffix
+        self.created = False
+
+    def load(self, prop_types=None):
+        self.stock_ids = {}
+        self.stock_names = {}
+        self.stockprops = set()
+        self.stockprop_types = {}
+        self.phenotypes = set()
+        if not self.created:
+            c = self.chado.con.cursor()
+            for table in [self.stage_stock, self.stage_pheno]:
+                c.execute(PSQLQ.create_stage_table.format(table=table))
+            self.chado.con.commit()
+            c.close()
+            self.created = True
+
+    def refresh(self):
+        '''Nothing to do, see stage().'''
+        pass
+
+    def stage(self, stock_names, pheno_uniquenames, prop_types):
+        '''Looks up the stocks named <stock_names>, their stockprops, the
+        stockprop types in <prop_types>, and which of <pheno_uniquenames>
+        exist.'''
+        pheno_uniquenames = set(pheno_uniquenames)
+        c = self.chado.con.cursor()
+        for table,values in [(self.stage_stock, stock_names),
+                             (self.stage_pheno, pheno_uniquenames)]:
+            c.execute(PSQLQ.truncate.format(table=table))
+            c.copy_from(_copy_rows(values), table, columns=('k',))
+            c.execute(PSQLQ.analyze.format(table=table))
+
+        self.stock_ids = {}
+        c.execute(PSQLQ.staged_stocks.format(stage=self.stage_stock,
+                                             col='uniquename'))
+        for uniquename, stock_id in c.fetchall():
+            self.stock_ids.setdefault(uniquename, stock_id)
+        c.execute(PSQLQ.staged_stocks.format(stage=self.stage_stock,
+                                             col='name'))
+        self.stock_names = dict(c.fetchall())
+
+        c.execute(PSQLQ.staged_stockprops.format(stage=self.stage_stock))
+        self.stockprops = set(c.fetchall())
+        self.stockprop_types = {}
+        if prop_types:
+            c.execute(PSQLQ.stockprop_types, (list(set(prop_types)),))
+            self.stockprop_types = dict(c.fetchall())
+
+        c.execute(PSQLQ.staged_new_phenotypes.format(stage=self.stage_pheno))
+        new = set(r[0] for r in c.fetchall())
+        self.phenotypes = pheno_uniquenames.difference(new)
+
+        # don't keep the transaction open
+        self.chado.con.commit()
+        c.close()
+
+    def close(self):
+        '''Drops our staging tables. This also runs after failed uploads,
+        where the transaction might be aborted, then the session drops them
+        later on.'''
+        if not self.created:
+            return
+        self.created = False
+        try:
+            c = self.chado.con.cursor()
+            for table in [self.stage_stock, self.stage_pheno]:
+                c.execute(PSQLQ.drop_table.format(table=table))
+            self.chado.con.commit()
+            c.close()
+        except Exception as e:
+            print '[-] could not drop the staging tables: {0}'.format(e)
+
+class BloomIndex(ChadoIndex):
+    '''Like ChadoIndex, but instead of all phenotype uniquenames, we keep a
+    Bloom filter of them, and self.phenotypes only holds those of the last
+    stage() call, which exist.
+
+    Most uniquenames of a round are new, and the filter tells so for sure.
+    Only its positive answers are confirmed with Chado.
+
+    The filter is saved to a LocalStore with the highest phenotype_id it
+    covers, so the next run only streams the phenotypes added since. It is
+    rebuilt, if the phenotype table was restored or truncated meanwhile.
+    '''
+    STAGED = True
+
+    def __init__(self, chado):
+        super(BloomIndex, self).__init__(chado)
+        dsn = getattr(chado.con, 'dsn', '') or ''
+        self.store = local_store.LocalStore('phenotype_bloom_'\
+                                            + md5(dsn).hexdigest()[:8])
+        self.bloom = None
+        self.relation = None # (oid, relfilenode) of the phenotype table
+
+    def load(self, prop_types=None):
+        # load() starts over at phenotype_id 0, so we start over with the
+        # saved filter, as close() left it
+        self.bloom = None
+        super(BloomIndex, self).load(prop_types=prop_types)
+        self.save()
+
+    def refresh(self):
+        if self.bloom is None:
+            self.__load_bloom()
+        super(BloomIndex, self).refresh()
+
+    def __load_bloom(self):
+        '''Takes the saved filter, if it has room for the phenotypes added
+        since, else streams all uniquenames into a new one. Either way,
+        refresh() adds what is new since.
+
+        We don't count(*) all phenotypes, but only those above the saved
+        max_id, or take Postgres' estimate, if there is no saved filter.
+
+        A restored or truncated phenotype table gets a new oid or
+        relfilenode, and might reuse ids up to the saved max_id, which
+        refresh() would never add, so then we don't take the saved filter.
+        '''
+        c = self.chado.con.cursor()
+        c.execute(PSQLQ.select_relation, ('phenotype',))
+        self.relation = tuple(c.fetchone())
+        c.execute(PSQLQ.select_max_id.format(table='phenotype',
+                                             id='phenotype_id'))
+        max_id = c.fetchone()[0]
+        bloom = self.store.get('filter')
+        if bloom and (self.store.get('relation') != self.relation
+                      or self.store['max_id'] > max_id):
+            print '[+] bloom: the phenotype table changed, rebuilding'
+            bloom = None
+        if bloom:
+            c.execute(PSQLQ.select_count_above_id.format(
+                table='phenotype', id='phenotype_id',
+                max=self.store['max_id']))
+            n = bloom.count + c.fetchone()[0]
+        else:
+            c.execute(PSQLQ.select_estimated_count, ('phenotype',))
+            n = c.fetchone()[0]
+        c.close()
+        if bloom and bloom.capacity >= n:
+            self.bloom = bloom
+            self.max_ids['phenotype'] = self.store['max_id']
+            return
+        self.__build_bloom(n)
+
+    def __build_bloom(self, n):
+        '''Streams all uniquenames into a new filter with room for <n> times
+        BLOOM_GROWTH.'''
+        self.bloom = BloomFilter(max(n, 1) * BLOOM_GROWTH, BLOOM_ERROR_RATE)
+        # server side cursor, so we never hold all of them
+        c = self.chado.con.cursor(name='mtods_bloom')
+        c.itersize = BLOOM_BATCH
+        c.execute(PSQLQ.select_above_id.format(
+            table='phenotype', id='phenotype_id',
+            columns='phenotype_id, uniquename', max=0))
+        max_id = 0
+        for phenotype_id, uniquename in c:
+            self.bloom.add(uniquename)
+            max_id = max(max_id, phenotype_id)
+        c.close()
+        self.max_ids['phenotype'] = max_id
+
+    def add_phenotypes(self, uniquenames):
+        '''Adds to the filter, which is rebuilt bigger, once it is full, e.g.
+        as Postgres' estimate was too low, or a run adds a lot.'''
+        self.bloom.update(uniquenames)
+        if self.bloom.full():
+            print '[+] bloom: filter of {0} is full, rebuilding'.format(
+                  self.bloom.capacity)
+            self.__build_bloom(self.bloom.count)
+
+    def save(self):
+        '''Saves the filter and the highest phenotype_id it covers.'''
+        self.store['filter'] = self.bloom
+        self.store['max_id'] = self.max_ids['phenotype']
+        self.store['relation'] = self.relation
+        self.store.save()
+
+    def stage(self, stock_names, pheno_uniquenames, prop_types):
+        '''Sets self.phenotypes to those of <pheno_uniquenames>, which exist
+        in Chado.'''
+        maybe = [u for u in set(pheno_uniquenames) if u in self.bloom]
+        self.phenotypes = set()
+        c = self.chado.con.cursor()
+        for i in range(0, len(maybe), BLOOM_BATCH):
+            c.execute(PSQLQ.select_phenotypes_in, (maybe[i:i+BLOOM_BATCH],))
+            self.phenotypes.update(r[0] for r in c.fetchall())
+        c.close()
+
+    def close(self):
+        self.save()
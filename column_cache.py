@@ -0,0 +1,82 @@
+'''
+Column metadata (USER_TAB_COLUMNS) cache, shared by all Oracle users.
+
+Our Oracle is far away, so we keep the column lists in memory and on disk
+(see local_store). Once per process, all cached entries are validated with a
+single cheap query for the LAST_DDL_TIME and column count of each table.
+'''
+import local_store
+from utility import OracleSQLQueries as OSQL
+from utility import normalize
+from utility import os_lock
+
+class ColumnCache(object):
+    '''Usage:
+        cache = ColumnCache()
+        cache.validate(cursor, ['T1', 'T2'])  # optional, saves round-trips
+        cache.columns(cursor, 'T1')           # -> ['COL1', 'COL 2', ..]
+        cache.headers(cursor, 'T1')           # -> ['COL1', 'COL_2', ..]
+    '''
+
+    def __init__(self, name='columns'):
+        self.store = local_store.LocalStore(name)
+        self.stamps = {}
+        # TableGuru reads the ontology and the columns in parallel threads
+        self.lock = os_lock()
+
+    def validate(self, cursor, tables=()):
+        '''Drop outdated entries for <tables> and everything we have cached,
+        unless already done by this process.'''
+        with self.lock:
+            self.__validate(cursor, tables)
+
+    def __validate(self, cursor, tables):
+        tables = set(tables).union(self.store.keys())
+        tables = tables.difference(self.stamps.keys())
+        if not tables:
+            return
+        names = ', '.join("'{}'".format(t) for t in tables)
+        cursor.execute(OSQL.get_ddl_stamps.format(tables=names))
+        stamps = {}
+        for name, ddl_time, ncolumns in cursor.fetchall():
+            stamps.setdefault(name, []).append((ddl_time, ncolumns))
+
+        outdated = False
+        for t in tables:
+            stamp = tuple(sorted(stamps.get(t, [])))
+            if self.store.has_key(t) and self.store[t][0] != stamp:
+                del self.store[t]
+                outdated = True
+            self.stamps[t] = stamp
+        if outdated:
+            self.store.save()
+
+    def get(self, cursor, table):
+        '''Returns the USER_TAB_COLUMNS rows for <table>, see
+        OracleSQLQueries.get_column_metadata_from.'''
+        with self.lock:
+            if not self.stamps.has_key(table):
+                self.__validate(cursor, [table])
+            if not self.store.has_key(table):
+                sql = OSQL.get_column_metadata_from.format(table=table)
+                cursor.execute(sql)
+                self.store[table] = (self.stamps[table], cursor.fetchall())
+                self.store.save()
+            return self.store[table][1]
+
+    def columns(self, cursor, table):
+        '''Returns the column names of <table>, ordered by COLUMN_ID.'''
+        return [line[1] for line in self.get(cursor, table)]
+
+    def headers(self, cursor, table):
+        '''Returns the column names of <table>, usable as attribute names.'''
+        return [normalize(c) for c in self.columns(cursor, table)]
+
+_shared = []
+_shared_lock = os_lock()
+def shared():
+    '''Returns the ColumnCache shared by all modules of this process.'''
+    with _shared_lock:
+        if not _shared:
+            _shared.append(ColumnCache())
+        return _shared[0]
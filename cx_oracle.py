@@ -12,10 +12,16 @@ Note:
 '''
 
 import utility
+import column_cache
 import cx_Oracle
 import sys
 from getpass import getpass
 import os # environ -> db pw
+import time
+from contextlib import contextmanager
+import heapq
+from collections import deque
+from operator import attrgetter
 from utility import OracleSQLQueries as OSQL
 
 # Don't worry he said, it's all internal he said.
@@ -26,71 +32,372 @@ PORT = 1521
 SID_KAPPA = 'CIAT'
 SID_RESEARCH = 'CIAT'
 SCHEMA = 'YUCA05'
+# Equivalent hosts, serving the same data, see Oracledb(hosts=..)
+HOSTS = [H_KAPPA, H_RESEARCH]
+# Round-trips per host to measure its latency, see Oracledb.rank_hosts()
+PING_ROUNDS = 3
+# Hosts slower than this factor times the fastest one are not used.
+SLOW_FACTOR = 2.0
+# Rows per network round-trip on fetch, and rows sent along with the execute
+# reply. Our link to kappa is slow, so bigger is better, within memory limits.
+ARRAYSIZE = 5000
+PREFETCH_ROWS = 5000
+# Key tuples per query in get_by_keys(), each costs len(keys) bind variables.
+KEYS_PER_QUERY = 1000
+# Dates come as strings in this format on extraction, see
+# Oracledb.cursor(convert=True), which is what Chado's COPY expects.
+DATE_FORMAT = 'YYYY-MM-DD'
+# Session pool size, see Oracledb.acquire()
+POOL_MIN = 1
+POOL_MAX = 8
+# Pooled sessions, which got our session settings, are tagged with this and
+# the schema, so we set them up only once, see Oracledb.__setup_session().
+SESSION_TAG = 'mtods'
 
 class Oracledb():
     '''Simple wrapper around cx_Oracle .makedsn, .connect, and some more basic
-    connection setup handling.'''
+    connection setup handling.
+
+    All our connections are sessions of one cx_Oracle.SessionPool per host,
+    which are shared with all clone()s. Besides our main connection (.con,
+    .cur), more sessions can be borrowed for concurrent reads with
+    acquire()/release(), or the session() context manager.
+
+    Given a list of equivalent <hosts>, we measure their latency on
+    connect(), use the fastest for our main connection, spread partitions
+    over all hosts that are not too slow, and fail over to the next host,
+    when one breaks down.'''
 
     debug = False
 
     def __init__(self, usr=USR, host=H_KAPPA, port=PORT, sid=SID_KAPPA, pw='',
-                 schema=SCHEMA, dsn=None):
+                 schema=SCHEMA, dsn=None, arraysize=ARRAYSIZE,
+                 prefetch=PREFETCH_ROWS, pool_min=POOL_MIN, pool_max=POOL_MAX,
+                 pool=None, hosts=None, pools=None, latency=None):
         '''Defaults to initialization with global variables.
         Note that if you provide a 'dsn', the 'host', 'port', and 'sid'
-        argument will be discarded.'''
+        argument will be discarded, and so will <hosts>.
+        <hosts> lists equivalent hosts, to balance the load across, <host>
+        defaults to the first of them.
+        <arraysize> and <prefetch> are the defaults for all our cursors, see
+        iter_rows().
+        <pool_min> and <pool_max> limit the number of open sessions, unless an
+        existing session <pool> is given. <pools> and <latency> are only
+        shared between clone()s.'''
         self.USR = usr
+        if dsn or not hosts:
+            hosts = [host]
+        elif host not in hosts:
+            host = hosts[0]
         self.HOST = host
+        self.HOSTS = list(hosts)
         self.PORT = port
         self.SID = sid
         self.__PW = pw
         self.SCHEMA = schema
         self.DSN = dsn
+        self.arraysize = arraysize
+        self.prefetch = prefetch
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+        self.pool = pool
+        self.pools = pools if pools is not None else {}
+        if pool:
+            self.pools[host] = pool
+        self.latency = latency if latency is not None else {}
+        self.databases = {} # host -> DB_NAME, see database()
+        self.borrowed = {} # id(connection) -> host
         self.con = None
         self.cur = None
         self.saved_curs = {}
+        self.fetch_stats = []
+        # Headers of columns, we don't convert to strings, see
+        # __output_type_handler(), copied to our clone()s.
+        self.native_columns = set()
+        self.conv_cur = None
 
     def connect(self):
         '''Returns a tuple(connection_obj, cursor_obj).'''
         # The following 3 if-statements MUST be exactly in this order.
-        if not self.DSN:
+        if not self.DSN and len(self.HOSTS) == 1:
             self.DSN = cx_Oracle.makedsn(self.HOST, self.PORT, self.SID)
         if self.debug:
             print '[+] connecting ( usr=%s, pw=1234, dsn=%s )' % (self.USR,
                                                                   self.DSN)
-        if not self.__PW:
+        if not self.__PW and not self.pool:
             if os.environ.has_key('ORACLEDB_PW'):
                 self.__PW = os.environ['ORACLEDB_PW']
             else:
                 self.__PW = getpass(prompt='Oracledb Password: ')
+        if not self.pool:
+            if len(self.HOSTS) > 1 and not self.latency:
+                self.HOST = self.rank_hosts()[0]
+            elif self.HOST not in self.usable_hosts():
+                self.HOST = self.usable_hosts()[0]
+            self.pool = self.__pool(self.HOST)
         if not self.con:
-            self.con = cx_Oracle.connect(self.USR, self.__PW, self.DSN)
-            self.con.current_schema = self.SCHEMA
+            self.con = self.acquire()
+            # we might have failed over
+            self.HOST = self.borrowed[id(self.con)]
+            self.pool = self.pools[self.HOST]
         if not self.cur:
-            self.cur = self.con.cursor()
+            self.cur = self.cursor()
         return self.con, self.cur
 
+    def __dsn(self, host):
+        if self.DSN and host == self.HOST:
+            return self.DSN
+        return cx_Oracle.makedsn(host, self.PORT, self.SID)
+
+    def __pool(self, host):
+        '''Returns the session pool for <host>, creating it if necessary.'''
+        if not self.pools.has_key(host):
+            pool = cx_Oracle.SessionPool(self.USR, self.__PW, self.__dsn(host),
+                                         self.pool_min, self.pool_max, 1,
+                                         threaded=True)
+            # block in acquire() instead of failing, when the pool is busy
+            pool.getmode = cx_Oracle.SPOOL_ATTRVAL_WAIT
+            self.pools[host] = pool
+        return self.pools[host]
+
+    def rank_hosts(self):
+        '''Measures the round-trip latency of each of our hosts, in parallel,
+        and returns usable_hosts(). Hosts we can't reach are marked with a
+        latency of None.'''
+        def ping(host):
+            try:
+                pool = self.__pool(host)
+                con = pool.acquire()
+            except cx_Oracle.DatabaseError as e:
+                print '[-] {0} unreachable: {1}'.format(host, e)
+                return host, None
+            try:
+                c = con.cursor()
+                best = None
+                for i in range(PING_ROUNDS):
+                    start = time.time()
+                    c.execute(OSQL.ping)
+                    c.fetchall()
+                    best = min(best or float('inf'), time.time() - start)
+                c.close()
+                pool.release(con)
+                return host, best
+            except cx_Oracle.DatabaseError as e:
+                print '[-] {0} unusable: {1}'.format(host, e)
+                pool.drop(con)
+                return host, None
+        self.latency.update(utility.parallel_map(ping, self.HOSTS))
+        if self.debug:
+            for h in self.HOSTS:
+                print '[+] latency {0}: {1}'.format(h, self.latency[h])
+        return self.usable_hosts()
+
+    def usable_hosts(self):
+        '''Returns our reachable hosts, fastest first, leaving out those
+        slower than SLOW_FACTOR times the fastest one. Before rank_hosts(),
+        or if none is reachable, that is all hosts in the given order.'''
+        times = [(t, self.HOSTS.index(h), h)
+                 for h,t in self.latency.iteritems()
+                 if t is not None and h in self.HOSTS]
+        if not times:
+            return list(self.HOSTS)
+        times.sort()
+        fastest = times[0][0]
+        return [h for t,i,h in times if t <= fastest * SLOW_FACTOR]
+
+    def acquire(self, host=None):
+        '''Returns a connection from the session pool of <host> (default:
+        ours), which must be handed back with release(). Blocks while all
+        sessions are busy. If <host> fails us, we mark it unusable and try
+        the other usable_hosts().'''
+        if not self.pool:
+            self.connect()
+        host = host or self.HOST
+        hosts = [host] + [h for h in self.usable_hosts() if h != host]
+        for n,h in enumerate(hosts):
+            con = None
+            try:
+                pool = self.__pool(h)
+                tag = '{0}:{1}'.format(SESSION_TAG, self.SCHEMA)
+                con = pool.acquire(tag=tag)
+                if con.tag != tag:
+                    self.__setup_session(con)
+                    # the session keeps this tag, when it is released
+                    con.tag = tag
+            except cx_Oracle.DatabaseError as e:
+                if con:
+                    pool.drop(con)
+                if n == len(hosts) - 1:
+                    raise
+                print '[-] failing over from {0}: {1}'.format(h, e)
+                self.latency[h] = None
+                continue
+            self.borrowed[id(con)] = h
+            return con
+
+    def release(self, con):
+        '''Hands a connection from acquire() back to its session pool.'''
+        host = self.borrowed.pop(id(con), self.HOST)
+        self.pools[host].release(con)
+
+    def failover(self, hosts=None):
+        '''Drops our main connection, marks our host unusable, and connects
+        to the next usable one, of <hosts> if given. Raises RuntimeError if
+        there is none.'''
+        bad = self.HOST
+        if self.con:
+            self.borrowed.pop(id(self.con), None)
+            try:
+                self.pools[bad].drop(self.con)
+            except cx_Oracle.DatabaseError:
+                pass
+        self.con = None
+        self.cur = None
+        self.conv_cur = None
+        self.pool = None
+        self.latency[bad] = None
+        others = [h for h in self.usable_hosts()
+                  if h != bad and (hosts is None or h in hosts)]
+        if not others:
+            raise RuntimeError('no host left to fail over to from ' + bad)
+        print '[-] failing over from {0} to {1}'.format(bad, others[0])
+        self.HOST = others[0]
+        return self.connect()
+
+    def database(self, host=None):
+        '''Returns the DB_NAME of the database behind <host> (default: ours),
+        or None if we can't reach it. Things like ORA_ROWSCN are only
+        comparable within one database, but all its hosts (RAC nodes,
+        standbys) share the DB_NAME and the SCNs.'''
+        if not self.pool:
+            self.connect()
+        host = host or self.HOST
+        if not self.databases.has_key(host):
+            con = self.acquire(host)
+            try:
+                c = con.cursor()
+                c.execute(OSQL.get_database)
+                # acquire() might have failed over to another host
+                self.databases[self.borrowed[id(con)]] = c.fetchone()[0]
+                c.close()
+            finally:
+                self.release(con)
+        return self.databases.get(host)
+
+    @contextmanager
+    def session(self):
+        '''with db.session() as con: ...  ,see acquire()'''
+        con = self.acquire()
+        try:
+            yield con
+        finally:
+            self.release(con)
+
+    def close(self):
+        '''Hands our main connection back to its session pool.'''
+        if self.con:
+            self.release(self.con)
+        self.con = None
+        self.cur = None
+        self.conv_cur = None
+
+    def __setup_session(self, con):
+        '''Session settings, which all our connections must share. They stick
+        with the pooled session, so acquire() only calls this for new ones,
+        see SESSION_TAG.'''
+        con.current_schema = self.SCHEMA
+        # Binary sorting, so that python compares like Oracle's ORDER BY, see
+        # iter_partitioned().
+        c = con.cursor()
+        c.execute(OSQL.set_binary_sort)
+        # see __output_type_handler()
+        c.execute(OSQL.set_date_format.format(fmt=DATE_FORMAT))
+        c.close()
+
+    def clone(self, host=None):
+        '''Returns a new, unconnected Oracledb with our connection settings,
+        sharing our session pools, which will connect to <host> (default:
+        ours).'''
+        if not self.pool:
+            self.connect()
+        host = host or self.HOST
+        db = Oracledb(usr=self.USR, host=host, port=self.PORT,
+                      sid=self.SID, pw=self.__PW, schema=self.SCHEMA,
+                      dsn=self.DSN, arraysize=self.arraysize,
+                      prefetch=self.prefetch, pool_min=self.pool_min,
+                      pool_max=self.pool_max, pool=self.pools.get(host),
+                      hosts=self.HOSTS, pools=self.pools,
+                      latency=self.latency)
+        db.native_columns = set(self.native_columns)
+        return db
+
+    def cursor(self, arraysize=None, prefetch=None, convert=False):
+        '''Returns a new cursor, with our fetch tuning applied. With
+        <convert> it returns dates and integers as strings, see
+        __output_type_handler().'''
+        c = self.con.cursor()
+        c.arraysize = arraysize or self.arraysize
+        if hasattr(c, 'prefetchrows'): # cx_Oracle >= 8
+            c.prefetchrows = prefetch or self.prefetch
+        if convert:
+            c.outputtypehandler = self.__output_type_handler
+        return c
+
+    def __conv_cursor(self):
+        '''Our converting cursor for the get_*() methods.'''
+        if not self.conv_cur:
+            self.conv_cur = self.cursor(convert=True)
+        return self.conv_cur
+
+    def __output_type_handler(self, cursor, name, default_type, size,
+                              precision, scale):
+        '''Let the Oracle client convert values to the strings we upload to
+        Chado, while fetching, instead of doing it value by value in python:
+            DATE, TIMESTAMP   -> 'YYYY-MM-DD' (see DATE_FORMAT)
+            NUMBER(p, 0)      -> '123'
+        Other numbers might come formatted like '.5', so we leave them alone,
+        as well as the self.native_columns, which we need to compare with
+        their Oracle ordering, e.g. keys.
+        '''
+        if utility.normalize(name) in self.native_columns:
+            return None
+        if default_type in (cx_Oracle.DATETIME, cx_Oracle.TIMESTAMP):
+            return cursor.var(cx_Oracle.STRING, len(DATE_FORMAT),
+                              cursor.arraysize)
+        if default_type == cx_Oracle.NUMBER and scale == 0 and precision > 0:
+            return cursor.var(cx_Oracle.STRING, precision + 1,
+                              cursor.arraysize)
+        return None
+
     # Tried to find a bug, didn't work..
     #@property
     #def cur(self):
     #    print '[ORACLE] accessing cursor @', hex(id(self.c))
     #    return self.c
 
-    def __check_lastheaders(self, table):
+    def __check_lastheaders(self, table, columns=None):
+        '''<columns> are the selected columns, if not all of <table>.'''
         if not hasattr(self, 'lasttable'):
             self.lasttable = table
-        if not hasattr(self, 'lastheaders') or (self.lasttable != table):
+        key = (table, tuple(columns or ()))
+        if not hasattr(self, 'lastheaders') or (self.lastkey != key):
             self.lasttable = table
-            header_sql = OSQL.get_column_metadata_from.format(table=table)
-            self.cur.execute(header_sql)
-            headers = [utility.normalize(i[1]) for i in self.cur.fetchall()]
-            self.lastheaders = headers
-
-    def __format(self, data, table):
-        'formats data as namedtuples'
-        self.__check_lastheaders(table)
+            self.lastkey = key
+            if columns:
+                self.lastheaders = [utility.normalize(c) for c in columns]
+            else:
+                cache = column_cache.shared()
+                self.lastheaders = cache.headers(self.cur, table)
+
+    def __format(self, data, table, columns=None, layout='namedtuple'):
+        '''formats data as namedtuples, or another <layout>, see
+        utility.ROW_LAYOUTS. <columns> are the selected columns, if not all
+        of <table>.'''
+        self.__check_lastheaders(table, columns)
         if hasattr(self, 'lastheaders') and hasattr(self, 'lasttable'):
             data = utility.make_namedtuple_with_headers(self.lastheaders,
-                                                        self.lasttable, data)
+                                                        self.lasttable, data,
+                                                        layout=layout)
         else: 
             raise RuntimeError('table not found')
         return data
@@ -117,10 +424,164 @@ class Oracledb():
 
         if save_as:
             self.saved_curs.update({save_as : self.cur})
-            self.cur = self.con.cursor()
+            self.cur = self.cursor()
 
         return data
 
+    def iter_rows(self, sql, batch=ARRAYSIZE*10, table=None, raw=False,
+                  arraysize=None, prefetch=None, binds=None, columns=None,
+                  layout='namedtuple', **kwargs):
+        '''Execute a <sql>-statement, and yield its result in lists of at most
+        <batch> rows, as they arrive. Other than get_rows() we never hold more
+        than one chunk in memory.
+
+        We use a cursor of our own, so self.cur stays usable meanwhile. Like
+        all get_*() methods, but get_rows(), it converts values, see
+        __output_type_handler().
+        <arraysize> rows are transfered per network round-trip, and
+        <prefetch> rows come along with the execute reply, both default to
+        the values given on __init__.
+        If <table> is given and not <raw>, rows are formatted as namedtuples,
+        with <columns> as fields, if <sql> does not select all of <table>, or
+        in another <layout>, see utility.ROW_LAYOUTS.
+        additional **kwargs will be used to sql.format(table=table, **kwargs)
+
+        For every chunk we append (chunk_n, rows, round_trips, seconds) to
+        self.fetch_stats, where round_trips is estimated from the arraysize.
+        '''
+        c = self.cursor(arraysize=arraysize, prefetch=prefetch, convert=True)
+        try:
+            self.fetch_stats = []
+            start = time.time()
+            c.execute(sql.format(table=table, **kwargs), binds or {})
+            prefetched = getattr(c, 'prefetchrows', 0)
+
+            chunk_n = 0
+            while True:
+                data = c.fetchmany(batch)
+                rows = len(data)
+                trips = -(-max(rows - prefetched, 0) // c.arraysize)
+                if rows < batch:
+                    trips += 1 # the one, telling us there is no more data
+                prefetched = 0
+                stat = (chunk_n, rows, trips, time.time() - start)
+                self.fetch_stats.append(stat)
+                if self.debug:
+                    msg = '[+] iter_rows chunk {0}: {1} rows, ~{2}'\
+                        + ' round-trips, {3:.2f}s'
+                    print msg.format(*stat)
+                chunk_n += 1
+
+                if not data:
+                    break
+                if table and not raw:
+                    data = self.__format(data, table, columns, layout)
+                yield data
+                if rows < batch:
+                    break
+                start = time.time()
+        finally:
+            # also if we are closed early, or fail
+            c.close()
+
+    def iter_partitioned(self, sql, keys, partitions, batch=ARRAYSIZE*10,
+                         table=None, binds=None, columns=None, hosts=None,
+                         **kwargs):
+        '''Generator over all rows of <sql>, ordered by the columns <keys>,
+        exactly like a serial fetch would return them.
+
+        The rows are split into <partitions> buckets by hashing <keys>, each
+        bucket is streamed on its own connection (see iter_rows()), and the
+        buckets are merged again in python. Whenever a bucket runs dry, all
+        buckets are refilled with the next <batch> rows in parallel.
+        The buckets are spread round-robin over our usable_hosts(), and if a
+        host fails, its buckets continue after their last row on another one.
+        Pass <hosts> to keep the buckets and their failover to those hosts,
+        e.g. the hosts of one database, if <sql> depends on it, like
+        ORA_ROWSCN does, see database().
+        The <keys> must be unique and NOT NULL.
+        additional **kwargs will be used to sql.format(**kwargs),
+        <binds> are passed to execute(), <columns> see iter_rows()
+        '''
+        hashed = " || '|' || ".join(keys)
+        cond = OSQL.hash_partition.format(cols=hashed, max=partitions - 1)
+        sql = OSQL.select_from_where.format(sub=sql, cond=cond)
+        kwargs.update({'ord' : ', '.join(keys)})
+
+        if not self.pool:
+            self.connect()
+        if partitions + 1 > self.pool.max:
+            msg = 'need {0} pooled sessions for {1} partitions, but pool_max'\
+                + ' is {2}'
+            raise RuntimeError(msg.format(partitions + 1, partitions,
+                                          self.pool.max))
+        allowed = hosts
+        hosts = hosts or self.usable_hosts()
+        dbs = [self.clone(host=hosts[i % len(hosts)])
+               for i in range(partitions)]
+        utility.parallel_map(lambda db: db.connect(), dbs)
+        key = attrgetter(*keys)
+        last = [None] * partitions # key of the last row fetched per bucket
+
+        def stream(i):
+            '''Rows of bucket <i>, after last[i], if any.'''
+            b = dict(binds or {})
+            b.update({'p' : i})
+            q = sql
+            if last[i] is not None:
+                after = last[i] if len(keys) > 1 else (last[i],)
+                cond, keybinds = utility.keyset_condition(keys, after)
+                q = OSQL.select_from_where.format(sub=q, cond=cond)
+                b.update(keybinds)
+            return dbs[i].iter_rows(q + OSQL.order_by, batch=batch,
+                                    table=table, binds=b, columns=columns,
+                                    **kwargs)
+        streams = [stream(i) for i in range(partitions)]
+        buffers = [deque() for i in range(partitions)]
+        live = set(range(partitions))
+        heads = [] # heap of (key, partition) for all non-empty buffers
+
+        def fetch(i):
+            while True:
+                try:
+                    chunk = next(streams[i], None)
+                    break
+                except cx_Oracle.DatabaseError as e:
+                    print '[-] partition {0} failed: {1}'.format(i, e)
+                    dbs[i].failover(allowed)
+                    streams[i] = stream(i)
+            if chunk:
+                last[i] = key(chunk[-1])
+            return i, chunk
+
+        try:
+            refill = list(live)
+            while True:
+                for i,chunk in utility.parallel_map(fetch, refill):
+                    if not chunk:
+                        live.discard(i)
+                        continue
+                    was_empty = not buffers[i]
+                    buffers[i].extend(chunk)
+                    if was_empty:
+                        heapq.heappush(heads, (key(buffers[i][0]), i))
+                if not heads:
+                    break
+
+                k,i = heapq.heappop(heads)
+                yield buffers[i].popleft()
+
+                refill = []
+                if buffers[i]:
+                    heapq.heappush(heads, (key(buffers[i][0]), i))
+                elif i in live:
+                    # We can't go on without the next row of <i>, so let the
+                    # others stock up too, while we wait anyway.
+                    refill = [j for j in live if len(buffers[j]) < batch]
+        finally:
+            for db in dbs:
+                db.close()
+
     def __get_tab_from_kwargs(self, kwargs):
         if kwargs.has_key('table'):
             table = kwargs['table']
@@ -130,19 +591,71 @@ class Oracledb():
             raise RuntimeError('Don\'t have table, but needed to __format()')
         return table
 
-    def get_first_n(self, sql, n, **kwargs):
-        '''additional **kwargs will be used to sql.format(**kwargs)'''
+    def get_first_n(self, sql, n, binds=None, columns=None, **kwargs):
+        '''additional **kwargs will be used to sql.format(**kwargs),
+        <binds> are passed to execute(), <columns> see iter_rows()'''
         sql = (sql + OSQL.first_N_only).format(N=n, **kwargs)
-        self.cur.execute(sql)
+        c = self.__conv_cursor()
+        c.execute(sql, binds or {})
         table = self.__get_tab_from_kwargs(kwargs)
-        return self.__format(self.cur.fetchall(), table)
+        return self.__format(c.fetchall(), table, columns)
 
-    def get_n_more(self, sql, n, offset=0, **kwargs):
-        '''additional **kwargs will be used to sql.format(**kwargs)'''
+    def get_n_more(self, sql, n, offset=0, binds=None, columns=None, **kwargs):
+        '''additional **kwargs will be used to sql.format(**kwargs),
+        <binds> are passed to execute(), <columns> see iter_rows()'''
         sql = (sql + OSQL.offset_O_fetch_next_N).format(N=n, O=offset, **kwargs)
-        self.cur.execute(sql)
+        c = self.__conv_cursor()
+        c.execute(sql, binds or {})
+        table = self.__get_tab_from_kwargs(kwargs)
+        return self.__format(c.fetchall(), table, columns)
+
+    def get_n_after(self, sql, n, keys, after=None, binds=None, columns=None,
+                    **kwargs):
+        '''Keyset ("seek") paging: fetch the next <n> rows, ordered by the
+        columns <keys>, that come after the key tuple <after>.
+
+        Other than get_n_more() we don't make Oracle sort and skip all
+        previous rows, so each call costs the same, no matter how deep into
+        the table we are. The <keys> must be unique and NOT NULL, and the
+        ORDER BY must agree with the comparisons of keyset_condition(), which
+        the binary NLS_SORT of __setup_session() takes care of.
+        additional **kwargs will be used to sql.format(**kwargs),
+        <binds> are passed to execute(), <columns> see iter_rows()
+        '''
+        binds = dict(binds or {})
+        if after:
+            cond, keybinds = utility.keyset_condition(keys, after)
+            sql = OSQL.select_from_where.format(sub=sql, cond=cond)
+            binds.update(keybinds)
+        kwargs.update({'ord' : ', '.join(keys)})
+        sql = (sql + OSQL.first_N_only).format(N=n, **kwargs)
+        c = self.__conv_cursor()
+        c.execute(sql, binds)
+        table = self.__get_tab_from_kwargs(kwargs)
+        return self.__format(c.fetchall(), table, columns)
+
+    def get_by_keys(self, sql, keys, values, binds=None, columns=None,
+                    **kwargs):
+        '''Returns the rows of <sql>, whose <keys> columns equal one of the
+        key tuples in <values>, ordered by <keys>. We ask for at most
+        KEYS_PER_QUERY key tuples per query.
+        additional **kwargs will be used to sql.format(**kwargs),
+        <binds> are passed to execute(), <columns> see iter_rows()
+        '''
+        kwargs.update({'ord' : ', '.join(keys)})
         table = self.__get_tab_from_kwargs(kwargs)
-        return self.__format(self.cur.fetchall(), table)
+        values = sorted(values)
+        c = self.__conv_cursor()
+        data = []
+        for i in range(0, len(values), KEYS_PER_QUERY):
+            cond, keybinds = utility.keys_in_condition(
+                keys, values[i:i+KEYS_PER_QUERY])
+            q = OSQL.select_from_where.format(sub=sql, cond=cond)
+            q = (q + OSQL.order_by).format(**kwargs)
+            keybinds.update(binds or {})
+            c.execute(q, keybinds)
+            data += c.fetchall()
+        return self.__format(data, table, columns)
 
     def fetch_more(self, n=None, raw=False, table=None, from_saved=None):
         '''Fetch more result from the last query, remembering the last output
@@ -174,9 +687,8 @@ class Oracledb():
             return utility.make_namedtuple_with_headers(self.lastheaders,
                                                         table, data)
         else:
-            header_sql = OSQL.get_column_metadata_from.format(table=table)
-            return utility.make_namedtuple_with_query(self.con.cursor(),
-                                                      header_sql, table, data)
+            headers = column_cache.shared().headers(self.con.cursor(), table)
+            return utility.make_namedtuple_with_headers(headers, table, data)
     def check_duplicates(self, table, column):
         cond = 't.{0} = t1.{0} )'.format(column)
         sql = (OSQL.get_all_from_uniq + cond).format(table=table)
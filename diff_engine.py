@@ -0,0 +1,116 @@
+'''
+Hash based "what is new" checks, between Oracle rows and Chado entries.
+
+The is_in(item, items) functions of TableGuru.create_equal_comparison() are
+called once per Oracle row, with the same list of all Chado entries each
+time. Instead of walking that list for every row, we index it once into a
+dict() or set(), so a whole round is diffed in linear time.
+'''
+import utility
+from task_storage import TaskStorage
+
+class Membership(object):
+    '''Callable is_in(item, items), see __doc__.
+
+    Subclasses build their index of <items> in index(), and look up single
+    <item>s in contains(). The index is rebuilt only, if we are called with
+    another <items> object.
+    '''
+
+    def __init__(self):
+        self.items = None
+        self.idx = None
+
+    def __call__(self, item, items):
+        if self.idx is None or self.items is not items:
+            self.items = items
+            self.idx = self.index(items)
+        return self.contains(item)
+
+    def index(self, items):
+        raise NotImplementedError()
+
+    def contains(self, item):
+        raise NotImplementedError()
+
+class StockMembership(Membership):
+    '''is_in(oracle_row, chado_stocks), comparing the Oracle column
+    <name_attr> with stock.uniquename. Instead of the stocks, <chado_stocks>
+    might be a dict() uniquename -> stock_id already, see chado_index.
+
+    Like the upload expects it, we record for every row we are called with:
+        TaskStorage.known_stock_ids  -> the stock_id, if known,
+                                        Duplicate(index) if we have seen the
+                                        new stock name already, else None
+        TaskStorage.unknown_stocks   -> the new stock names, in order
+    '''
+
+    def __init__(self, name_attr):
+        super(StockMembership, self).__init__()
+        self.name_attr = name_attr
+        self.positions = {} # unknown stock name -> index in unknown_stocks
+        TaskStorage.known_stock_ids = []
+        TaskStorage.unknown_stocks = []
+
+    def index(self, chads):
+        if type(chads) is dict:
+            return chads
+        ids = {}
+        for c in chads:
+            ids.setdefault(c.uniquename, c.stock_id) # first one wins
+        return ids
+
+    def contains(self, ora):
+        name = getattr(ora, self.name_attr)
+        stock_id = self.idx.get(name)
+        if stock_id is not None:
+            TaskStorage.known_stock_ids.append(stock_id)
+            return True
+        if self.positions.has_key(name):
+            dup = utility.Duplicate(self.positions[name])
+            TaskStorage.known_stock_ids.append(dup)
+        else:
+            self.positions[name] = len(TaskStorage.unknown_stocks)
+            TaskStorage.unknown_stocks.append(name)
+            TaskStorage.known_stock_ids.append(None)
+        return False
+
+class StockpropMembership(Membership):
+    '''is_in([stock.name, property], [[stock_id, type_id], ..]), using the
+    mappings stock.name -> stock_id, and property -> cvterm_id.'''
+
+    def __init__(self, stock_ids, prop_ids):
+        super(StockpropMembership, self).__init__()
+        self.stock_ids = stock_ids
+        self.prop_ids = prop_ids
+
+    def index(self, currents):
+        if type(currents) in (set, frozenset):
+            return currents
+        return set(tuple(c) for c in currents)
+
+    def contains(self, sp):
+        s,p = sp
+        if not self.stock_ids.has_key(s):
+            return False
+        if not self.prop_ids.has_key(p):
+            msg = 'No Key: Mapping(:stock_id => :cvterm_id) "{}"'
+            raise Warning(msg.format(p))
+        return (self.stock_ids[s], self.prop_ids[p]) in self.idx
+
+class SetMembership(Membership):
+    '''is_in(set(names), names), True if any of the names is known.'''
+
+    def index(self, items):
+        if type(items) in (set, frozenset):
+            return items
+        return set(items)
+
+    def contains(self, names):
+        return not self.idx.isdisjoint(names)
+
+def unknown_rows(rows, keys, is_in, known):
+    '''Returns the distinct <rows>, in order, for whose corresponding entry
+    in <keys> is_in(key, <known>) is False. is_in() is called for every row,
+    as it might record something, see StockMembership.'''
+    return utility.uniq(r for r,k in zip(rows, keys) if not is_in(k, known))
@@ -0,0 +1,51 @@
+'''
+Local state, which has to survive between our cron runs.
+
+Everything lives as pickle files in STATE_DIR, which mtods.py lets you
+configure.
+'''
+import os
+import cPickle
+import tempfile
+
+STATE_DIR = os.path.join(os.path.expanduser('~'), '.mtods')
+
+class LocalStore(dict):
+    '''A dict(), that is persisted to <STATE_DIR>/<name>.pickle by save().
+
+    Unreadable or missing files result in an empty store, as all we keep here
+    can be recomputed.
+    '''
+
+    def __init__(self, name, basedir=None):
+        super(LocalStore, self).__init__()
+        self.path = os.path.join(basedir or STATE_DIR, name + '.pickle')
+        self.load()
+
+    def load(self):
+        '''(Re-)Read the store from disk.'''
+        self.clear()
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as fd:
+                self.update(cPickle.load(fd))
+        except (IOError, EOFError, cPickle.UnpicklingError) as e:
+            print '[local_store] ignoring broken {0}: {1}'.format(self.path, e)
+
+    def save(self):
+        '''Atomically write the store to disk.'''
+        d = os.path.dirname(self.path)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        # Unique temporary file, as other threads or processes might save()
+        # as well.
+        fd, tmp = tempfile.mkstemp(dir=d, prefix=os.path.basename(self.path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump(dict(self), f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
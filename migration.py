@@ -36,13 +36,24 @@ class Migration(utility.VerboseQuiet):
 
     BASE_DIR = ''
 
-    def __init__(self, verbose=False, quiet=False, basedir=None, **tgargs):
+    def __init__(self, verbose=False, quiet=False, basedir=None,
+                 pool_min=cx_oracle.POOL_MIN, pool_max=cx_oracle.POOL_MAX,
+                 hosts=None, extract_only=False, workers=1, **tgargs):
         '''We set some configuration, connect to the database, and create a
         local cursor object.
 
         Arguments:
             verbose     print lots of debug info
             quiet       daemon mode, be silent
+            pool_min    minimum number of pooled Oracle sessions
+            pool_max    maximum number of pooled Oracle sessions, raised if
+                        needed for the partitions
+            hosts       list of equivalent Oracle hosts, to balance the load
+                        across (default: cx_oracle.H_KAPPA only)
+            extract_only
+                        only write snapshots, nothing is uploaded, see
+                        TableGuru.extract()
+            workers     number of tables full() migrates at the same time
         '''
         super(self.__class__, self).__init__()
         if basedir:
@@ -51,12 +62,31 @@ class Migration(utility.VerboseQuiet):
             self.BASE_DIR = os.getcwd()
         self.VERBOSE = verbose
         self.QUIET = quiet
-        self.db = cx_oracle.Oracledb()
+        self.extract_only = extract_only
+        if workers < 1:
+            raise RuntimeError('<workers> must be at least 1')
+        self.workers = workers
+        self.tgargs = tgargs
+        # every partition streams on a session of its own, plus the main one
+        # of each worker, plus ours
+        partitions = tgargs.get('partitions', 1)
+        sessions = workers * (partitions + 1) + 1
+        self.db = cx_oracle.Oracledb(pool_min=pool_min,
+                                     pool_max=max(pool_max, sessions),
+                                     hosts=hosts)
         if self.VERBOSE: self.db.debug = True
         self.connection, self.cursor = self.db.connect()
         self.vprint('[+] connected')
-        self.tg = table_guru.TableGuru('', self.db, self.VERBOSE,
-                                       basedir=basedir, **tgargs)
+        self.basedir = basedir
+        self.tg = None # see __table_guru()
+
+    def __table_guru(self):
+        '''Our TableGuru for single(), built on first use, as it loads the
+        ontology and connects to Chado, which concurrent() does per worker.'''
+        if self.tg is None:
+            self.tg = table_guru.TableGuru('', self.db, self.VERBOSE,
+                                           basedir=self.basedir, **self.tgargs)
+        return self.tg
 
     def __get_tables(self):
         self.cursor.execute(utility.OracleSQLQueries.get_table_names)
@@ -68,22 +98,74 @@ class Migration(utility.VerboseQuiet):
 
     def full(self):
         '''We call the table migration task for all tables in
-        TABLES_MIGRATION_IMPLEMENTED.
+        TABLES_MIGRATION_IMPLEMENTED, up to self.workers at the same time.
         '''
         if not os.path.exists(self.BASE_DIR):
             msg = '[.full] non existent path "{}"'
             raise RuntimeError(msg.format(self.BASE_DIR))
         self.vprint('[+] basedir = "{0}"'.format(self.BASE_DIR))
 
-        for table in self.__get_tables():
-            if table in self.TABLES_MIGRATION_IMPLEMENTED:
+        tables = [t for t in self.__get_tables()
+                  if t in self.TABLES_MIGRATION_IMPLEMENTED]
+        if self.workers == 1 or len(tables) < 2:
+            for table in tables:
                 self.single(table)
+        else:
+            self.concurrent(tables)
 
     def single(self, table):
         '''Migrates a single table, including upload if specified.'''
+        self.__migrate(self.__table_guru(), table)
+
+    def __migrate(self, tg, table):
         self.vprint('[+] starting migrate({})'.format(table))
-        self.tg.table = table
-        tasks_generator = self.tg.create_upload_tasks()
-        for suite in tasks_generator:
-            Task.parallel_upload(suite)
+        tg.table = table
+        if self.extract_only:
+            tg.extract()
+            return
+        tasks_generator = tg.create_upload_tasks()
+        try:
+            for suite in tasks_generator:
+                Task.parallel_upload(suite)
+        finally:
+            # releases the TableGuru's lock, if the upload failed
+            tasks_generator.close()
+
+    def concurrent(self, tables):
+        '''Migrates <tables> in self.workers threads.
+
+        Each worker has its own TableGuru, thus its own Oracle and Chado
+        connections. Their diffs and uploads are serialized by one shared
+        lock, so stocks, sites or cvterms, which several tables reference,
+        are inserted only once. The Oracle fetches of all tables run
+        meanwhile, in the background, see TableGuru's <pipeline>.
+        '''
+        lock = threading.Lock()
+        tgargs = dict(self.tgargs)
+        tgargs['pipeline'] = max(tgargs.get('pipeline', 0), 1)
+        todo = list(reversed(tables))
+        errors = []
+
+        def work():
+            table = None
+            try:
+                tg = table_guru.TableGuru('', self.db.clone(), self.VERBOSE,
+                                          basedir=self.basedir, lock=lock,
+                                          **tgargs)
+                while todo and not errors:
+                    table = todo.pop()
+                    self.__migrate(tg, table)
+            except Exception as e:
+                msg = '[-] migrate({0}) failed: {1}'
+                self.qprint(msg.format(table, e))
+                errors.append(e)
+
+        n = min(self.workers, len(tables))
+        self.vprint('[+] migrating {0} tables in {1} workers'.format(
+            len(tables), n))
+        ts = [threading.Thread(target=work) for _ in range(n)]
+        map(lambda x: x.start(), ts)
+        map(lambda x: x.join(), ts)
+        if errors:
+            raise errors[0]
 
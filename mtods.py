@@ -14,6 +14,9 @@ import sys
 import table_guru
 import migration
 import chado
+import cx_oracle
+import local_store
+import chado_index
 
 BASE_DIR = os.getcwd()
 CONF_FILENAME = 'trans.conf'
@@ -37,8 +40,30 @@ def main():
         if a[0] and b[0]:
             parser.error(mutally_exclusive_msg.format(a[1],b[1]))
 
+    if (o.replay or o.extract_only) and not o.snapshot_dir:
+        parser.error('options --replay and --extract-only need --snapshot-dir')
+    if o.replay and o.extract_only:
+        parser.error(mutally_exclusive_msg.format('--replay',
+                                                  '--extract-only'))
+    if o.partitions < 1:
+        parser.error('option --partitions must be at least 1')
+    if o.pipeline < 0:
+        parser.error('option --pipeline must not be negative')
+    if o.workers < 1:
+        parser.error('option --workers must be at least 1')
+    if o.round_min < 0 or o.round_max < 0 or o.max_rss < 0:
+        parser.error('options --round-* and --max-rss must not be negative')
+    if o.round_min and o.round_max and o.round_min > o.round_max:
+        parser.error('need --round-min <= --round-max')
+    if (o.round_max or o.max_rss) and not o.round_min:
+        parser.error('options --round-max and --max-rss need --round-min')
+    if o.pool_min < 1 or o.pool_max < o.pool_min:
+        parser.error('need 1 <= --pool-min <= --pool-max')
+
     if o.config_path:
         table_guru.CONF_PATH = o.config_path
+    if o.state_dir:
+        local_store.STATE_DIR = o.state_dir
 
     if o.pg_user:
         chado.USER = o.pg_user
@@ -49,7 +74,19 @@ def main():
 
     migra = migration.Migration(verbose=o.verbose, quiet=o.quiet,
                                 chado_db=o.ch_db, chado_cv=o.ch_cv,
-                                chado_dataset=o.ch_pj)
+                                chado_dataset=o.ch_pj, paging=o.paging,
+                                partitions=o.partitions,
+                                pool_min=o.pool_min, pool_max=o.pool_max,
+                                hosts=o.oracle_hosts.split(','),
+                                full_resync=o.full_resync,
+                                fingerprints=o.fingerprints,
+                                snapshot_dir=o.snapshot_dir or None,
+                                replay=o.replay, extract_only=o.extract_only,
+                                diff_mode=o.diff_mode, pipeline=o.pipeline,
+                                workers=o.workers, resume=o.resume,
+                                round_min=o.round_min or None,
+                                round_max=o.round_max or None,
+                                max_rss=o.max_rss * 2**20 or None)
     if o.single_table:
         migra.single(o.single_table)
     else:
@@ -71,6 +108,68 @@ def optparse_init():
         dest='config_path', help=\
         'path to the table translation config (default: {})'\
         .format('<basedir>/'+CONF_FILENAME), metavar='<path>', default='')
+    p.add_option('--state-dir', action='store', type='string',
+        dest='state_dir', help='directory for caches and state, kept between'\
+        ' runs (default: {})'.format(local_store.STATE_DIR),
+        metavar='<path>', default='')
+    p.add_option('--full-resync', action='store_true', dest='full_resync',
+        help='read all Oracle rows, not only the ones changed since the last'\
+        ' complete run', metavar='', default=False)
+    p.add_option('--fingerprints', action='store_true', dest='fingerprints',
+        help='let Oracle hash all rows, and only fetch new or changed ones',
+        metavar='', default=False)
+    p.add_option('--snapshot-dir', action='store', type='string',
+        dest='snapshot_dir', help='keep a local snapshot of every extracted'\
+        ' table in this directory', metavar='<path>', default='')
+    p.add_option('--extract-only', action='store_true', dest='extract_only',
+        help='only write the snapshots, upload nothing', metavar='',
+        default=False)
+    p.add_option('--replay', action='store_true', dest='replay',
+        help='upload the snapshots, instead of reading Oracle', metavar='',
+        default=False)
+    p.add_option('--resume', action='store_true', dest='resume',
+        help='continue after the last uploaded round of an aborted run',
+        metavar='', default=False)
+    p.add_option('--diff-mode', action='store', type='choice',
+        choices=chado_index.DIFF_MODES, dest='diff_mode', help=\
+        'where to find out, which rows are new, one of {} (default: client)'\
+        .format(chado_index.DIFF_MODES), metavar='<mode>', default='client')
+    p.add_option('--paging', action='store', type='choice',
+        choices=table_guru.PAGING_MODES, dest='paging', help=\
+        'how to page through the Oracle tables, one of {} (default: keyset)'\
+        .format(table_guru.PAGING_MODES), metavar='<mode>', default='keyset')
+    p.add_option('--partitions', action='store', type='int',
+        dest='partitions', help='extract each table in N hash-partitions,'\
+        ' in parallel on N Oracle connections (default: 1)', metavar='N',
+        default=1)
+    p.add_option('--pipeline', action='store', type='int', dest='pipeline',
+        help='fetch up to N rounds ahead, while uploading the current one'\
+        ' (default: 0, off)', metavar='N', default=0)
+    p.add_option('--workers', action='store', type='int', dest='workers',
+        help='migrate up to N tables at the same time, without -s'\
+        ' (default: 1)', metavar='N', default=1)
+    p.add_option('--round-min', action='store', type='int', dest='round_min',
+        help='adapt the rows per round to the measured throughput and memory,'\
+        ' starting at, and never below N (default: 0, fixed rounds)',
+        metavar='N',
+        default=0)
+    p.add_option('--round-max', action='store', type='int', dest='round_max',
+        help='with --round-min, never more than N rows per round (default:'\
+        ' 600000)', metavar='N', default=0)
+    p.add_option('--max-rss', action='store', type='int', dest='max_rss',
+        help='with --round-min, keep the resident set size below MB'\
+        ' megabytes (default: 0, no limit)', metavar='MB', default=0)
+    p.add_option('--pool-min', action='store', type='int', dest='pool_min',
+        help='minimum number of pooled Oracle sessions (default: {})'\
+        .format(cx_oracle.POOL_MIN), metavar='N', default=cx_oracle.POOL_MIN)
+    p.add_option('--pool-max', action='store', type='int', dest='pool_max',
+        help='maximum number of pooled Oracle sessions (default: {})'\
+        .format(cx_oracle.POOL_MAX), metavar='N', default=cx_oracle.POOL_MAX)
+    p.add_option('--oracle-hosts', action='store', type='string',
+        dest='oracle_hosts', help='comma separated list of equivalent Oracle'\
+        ' hosts, we pick the fastest and spread partitions across them'\
+        ' (default: {})'.format(','.join(cx_oracle.HOSTS)), metavar='<hosts>',
+        default=','.join(cx_oracle.HOSTS))
 
     pgo = optparse.OptionGroup(p, 'Postgres Connection Options', '')
     pgo.add_option('-y', '--pg_host', action='store', type='string',
@@ -0,0 +1,97 @@
+'''
+Round sizes for TableGuru.create_upload_tasks().
+
+A fixed number of rows per round is either too much for the memory of a
+small host, or too little to amortize the setup of each round (Chado
+lookups, task creation, ..) on a big one. RoundSizer measures every round,
+and picks the size of the next one within [min_size, max_size]:
+    - grow or shrink by FACTOR, keeping the direction while the throughput
+      (rows per second of fetch, diff and upload) improves, else turn, and
+      take smaller steps from then on, so the size settles
+    - but never more rows than fit below <max_rss>, estimated from how much
+      the resident set size grew per row during the last round, and no
+      growth at all, while we are above <max_rss> already
+Start small, e.g. at min_size, as nothing is measured before the first
+round, so <max_rss> can't protect it.
+'''
+import resource
+
+FACTOR = 1.5
+# On each turn, the factor becomes 1/factor**DAMPING, i.e. 1.5, 0.82, 1.05, ..
+DAMPING = 0.5
+
+def rss():
+    '''The resident set size of this process, in bytes.'''
+    try:
+        with open('/proc/self/statm') as fd:
+            return int(fd.read().split()[1]) * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        # not Linux, the peak size in kB will do
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class FixedSize(object):
+    '''Every round has <size> rows.'''
+
+    def __init__(self, size):
+        self.size = size
+
+    def start(self):
+        '''Called before fetching each round.'''
+        pass
+
+    def observe(self, rows, fetch, diff, upload):
+        '''Called after each round of <rows> rows, with the seconds it took
+        to <fetch>, <diff> and <upload> it.'''
+        pass
+
+class RoundSizer(FixedSize):
+    '''Usage:
+        sizer = RoundSizer(10000, 10000, 1000000, max_rss=2 * 1024**3)
+        while ..:
+            sizer.start()
+            rows = fetch(sizer.size)
+            ..
+            sizer.observe(len(rows), fetch_s, diff_s, upload_s)
+
+    self.history lists (size, rows, seconds, rss) of each observed round.
+    '''
+
+    def __init__(self, size, min_size, max_size, max_rss=None):
+        if not 0 < min_size <= max_size:
+            raise RuntimeError('need 0 < <min_size> <= <max_size>')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_rss = max_rss
+        self.size = self.__clamp(size)
+        self.before = None
+        self.factor = FACTOR
+        self.throughput = None
+        self.history = []
+
+    def __clamp(self, size):
+        return max(self.min_size, min(self.max_size, int(size)))
+
+    def start(self):
+        self.before = rss()
+
+    def observe(self, rows, fetch, diff, upload):
+        seconds = fetch + diff + upload
+        used = rss()
+        self.history.append((self.size, rows, seconds, used))
+        if not rows:
+            return
+
+        throughput = rows / max(seconds, 1e-3)
+        if self.throughput is not None and throughput < self.throughput:
+            self.factor = 1 / self.factor ** DAMPING
+        self.throughput = throughput
+        size = self.size * self.factor
+
+        if self.max_rss and self.before is not None:
+            headroom = self.max_rss - self.before
+            per_row = max(used - self.before, 0) / float(rows)
+            if headroom <= 0:
+                size = min(size, self.size)
+            elif per_row:
+                size = min(size, headroom / per_row)
+        self.size = self.__clamp(size)
@@ -0,0 +1,92 @@
+'''
+Local snapshots of extracted Oracle rounds, so we can load them into Chado
+again, without touching the slow Oracle.
+
+A snapshot is a directory <basedir>/<table>/, holding one gzipped pickle per
+round, and an index (see local_store), listing the rounds in order:
+    index['fields']    -> the namedtuple fields of the rows
+    index['rounds']    -> [(filename, number of rows), ..]
+    index['complete']  -> True, once all rounds of the extraction are written
+
+Rounds are stored columnar, i.e. one tuple per column, which compresses a lot
+better, than the rows do.
+'''
+import os
+import gzip
+import cPickle
+import utility
+import local_store
+
+ROUND_FILE = 'round_{0:05d}.pickle.gz'
+
+def table_dir(basedir, table):
+    return os.path.join(basedir, table)
+
+class SnapshotWriter(object):
+    '''Usage:
+        w = SnapshotWriter('/some/dir', 'TABLE')
+        for rows in rounds:
+            w.write(rows)
+        w.finish()
+    Starting a writer drops any earlier snapshot of <table> in <basedir>.
+    '''
+
+    def __init__(self, basedir, table):
+        self.dir = table_dir(basedir, table)
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        self.index = local_store.LocalStore('index', basedir=self.dir)
+        for name,n in self.index.get('rounds', []):
+            path = os.path.join(self.dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        self.index.clear()
+        self.index.update({'fields' : None, 'rounds' : [], 'complete' : False})
+        self.index.save()
+
+    def write(self, rows):
+        '''Appends the namedtuples <rows> as the next round.'''
+        if not rows:
+            return
+        if self.index['fields'] is None:
+            self.index['fields'] = list(rows[0]._fields)
+        name = ROUND_FILE.format(len(self.index['rounds']))
+        path = os.path.join(self.dir, name)
+        tmp = path + '.tmp'
+        with gzip.open(tmp, 'wb') as fd:
+            cPickle.dump(zip(*rows), fd, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+        self.index['rounds'].append((name, len(rows)))
+        self.index.save()
+
+    def finish(self):
+        '''Marks the snapshot as complete, and thus readable.'''
+        self.index['complete'] = True
+        self.index.save()
+
+class SnapshotReader(object):
+    '''Usage:
+        for rows in SnapshotReader('/some/dir', 'TABLE').rounds():
+            ..
+    '''
+
+    def __init__(self, basedir, table):
+        self.table = table
+        self.dir = table_dir(basedir, table)
+        self.index = local_store.LocalStore('index', basedir=self.dir)
+        if not self.index.get('complete'):
+            msg = 'no complete snapshot of {0} in {1}'
+            raise RuntimeError(msg.format(table, basedir))
+
+    def __len__(self):
+        return sum(n for name,n in self.index['rounds'])
+
+    def rounds(self, start=0):
+        '''Generator over the rounds, as lists of namedtuples, exactly like
+        they were written, beginning with round number <start>.'''
+        for name,n in self.index['rounds'][start:]:
+            with gzip.open(os.path.join(self.dir, name), 'rb') as fd:
+                columns = cPickle.load(fd)
+            yield utility.make_namedtuple_with_headers(self.index['fields'],
+                                                       self.table,
+                                                       zip(*columns))
@@ -1,16 +1,40 @@
 import utility
 from utility import OracleSQLQueries as OSQL
-from utility import get_uniq_id as uid
 import chado
 import cassava_ontology
+import column_cache
+import local_store
+import snapshot
+import diff_engine
+import translation
+import chado_index
+import round_sizer
 import ConfigParser
 import os
+import threading
 import datetime, time
-from task_storage import TaskStorage
+from itertools import islice, chain
 
 # Path to the translation cfg file.
 CONF_PATH = 'trans.conf'
 GERMPLASM_TYPE = 'cultivar' # constant(3 options) from MCL
+# keyset: seek past the last unique_id of the previous round (constant cost)
+# offset: OFFSET/FETCH NEXT, Oracle re-sorts and skips all previous rows
+# stream: a single query, rounds are chunks of one open cursor (long running
+#         cursors might hit ORA-01555 if the source changes meanwhile)
+PAGING_MODES = ['keyset', 'offset', 'stream']
+# Oracle column or pseudo column, which only grows for new or changed rows,
+# unless overwritten in TableGuru.WATERMARK_COLUMNS. Note that a complete
+# refresh of a materialized view renews all ORA_ROWSCNs, thus all rows.
+# Unless the table was created with ROWDEPENDENCIES, ORA_ROWSCN is tracked per
+# block, not per row, so we also re-read the unchanged neighbours of a changed
+# row, which the diff then skips. SCNs are only comparable within the same
+# database, see __source_query().
+DEFAULT_WATERMARK = 'ORA_ROWSCN'
+PER_DATABASE_WATERMARKS = ['ORA_ROWSCN']
+# Columns per row fingerprint, as 32 hex digits per column must stay below the
+# 4000 bytes of a VARCHAR2, see TableGuru.__fingerprint_rounds().
+FINGERPRINT_COLUMNS = 100
 
 class ThisIsBad(RuntimeError):     pass
 class ThisIsVeryBad(RuntimeError): pass
@@ -29,13 +53,18 @@ class TableGuru(utility.VerboseQuiet):
     The TRANS_C dict contains constanst relationships, that have to be
     populated by asking chado.
 
+    TRANSLATIONS holds the compiled translation.Translation per table, see
+    get_translation().
+
     All __check_and_add_*-functions return a list() of created upload-tasks.
     If none have to be added an empty list is returned.
     '''
 
     TRANS = {}
     TRANS_C = {}
+    TRANSLATIONS = {}
     COLUMNS = {}
+    WATERMARK_COLUMNS = {} # table -> column, see DEFAULT_WATERMARK
 
     ALL_TABLES = [
         'VM_RESUMEN_ENFERMEDADES',
@@ -46,13 +75,41 @@ class TableGuru(utility.VerboseQuiet):
 
     def __init__(self, table, oracledb, verbose=False, basedir='', update=True,
                  chado_db='mcl_pheno', chado_cv='mcl_pheno',
-                 chado_dataset='mcl_pheno'):
+                 chado_dataset='mcl_pheno', paging='keyset', partitions=1,
+                 full_resync=False, fingerprints=False, snapshot_dir=None,
+                 replay=False, diff_mode='client', pipeline=0, lock=None,
+                 resume=False, round_min=None, round_max=None, max_rss=None):
         '''We initialize (once per session, nor per __init__ call!)
         TableGuru.COLUMNS such that:
             TableGuru.COLUMNS[<tablename>][0] -> first  column name
             TableGuru.COLUMNS[<tablename>][1] -> second column name..
 
         And TableGuru.TRANS with empty dict()'s.
+
+        <paging> selects how we page through the Oracle table, see
+        PAGING_MODES.
+        If <partitions> is bigger than 1, we extract that many hash-partitions
+        of the table in parallel, each on its own connection, which replaces
+        <paging>.
+        Unless <full_resync> is set, we only read rows, which changed since
+        the last complete run, see __source_query().
+        With <fingerprints> we let Oracle hash the rows first, and only fetch
+        those we have not seen like this before, see __fingerprint_rounds().
+        With <snapshot_dir> we keep a snapshot of every table we extract,
+        and with <replay> we read the rounds from there instead of Oracle,
+        see snapshot.
+        <diff_mode> selects where we find out what is new, see
+        chado_index.DIFF_MODES.
+        With a <pipeline> depth above 0, we fetch that many rounds ahead in
+        the background, while the current one is diffed and uploaded, see
+        create_upload_tasks().
+        Several TableGurus, migrating at the same time, must share one
+        <lock>, which serializes their diffs and uploads.
+        With <resume> we continue after the last round, an earlier run
+        uploaded, see __save_checkpoint().
+        With <round_min> set, the number of rows per round starts at it, and
+        adapts between it and <round_max>, keeping the resident set size
+        below <max_rss> bytes, see round_sizer.
         '''
         super(self.__class__, self).__init__()
         self.VERBOSE = verbose
@@ -62,15 +119,49 @@ class TableGuru(utility.VerboseQuiet):
         if not update:
             raise Warning('Deprecated flag: "update", only usefull for'\
                 + ' spreadsheets.')
+        if not paging in PAGING_MODES:
+            msg = 'unknown <paging> argument: {0}, must be in {1}'
+            raise RuntimeError(msg.format(paging, PAGING_MODES))
+        self.paging = paging
+        self.partitions = partitions
+        self.full_resync = full_resync
+        self.fingerprints = fingerprints
+        self.next_fingerprints = {}
+        if replay and not snapshot_dir:
+            raise RuntimeError('<replay> needs a <snapshot_dir>')
+        if not diff_mode in chado_index.DIFF_MODES:
+            msg = 'unknown <diff_mode> argument: {0}, must be in {1}'
+            raise RuntimeError(msg.format(diff_mode, chado_index.DIFF_MODES))
+        self.snapshot_dir = snapshot_dir
+        self.replay = replay
+        if pipeline < 0:
+            raise RuntimeError('<pipeline> must not be negative')
+        self.pipeline = pipeline
+        self.lock = lock or threading.Lock()
+        self.resume = resume
+        self.checkpoint = None
+        if round_min and round_max and round_min > round_max:
+            raise RuntimeError('<round_min> must not exceed <round_max>')
+        self.round_min = round_min
+        self.round_max = round_max
+        self.max_rss = max_rss
+        self.counts = {}
+        self.round_cache = {}
 
         self.oracle = oracledb
         if not self.oracle.cur:
             self.oracle.connect()
-        self.c = oracledb.cur
         self.chado = chado.ChadoPostgres()
-        self.onto = cassava_ontology.CassavaOntology(self.c)
 
         self.linker = chado.ChadoDataLinker(self.chado, chado_db, chado_cv)
+        # loaded in create_upload_tasks()
+        self.diff_mode = diff_mode
+        if diff_mode == 'server':
+            self.chado_index = chado_index.StagedIndex(self.chado)
+        elif diff_mode == 'bloom':
+            self.chado_index = chado_index.BloomIndex(self.chado)
+        else:
+            self.chado_index = chado_index.ChadoIndex(self.chado)
 
         self.table = table
         self.dbname = chado_db
@@ -78,8 +169,16 @@ class TableGuru(utility.VerboseQuiet):
         self.dataset = chado_dataset
 
         self.__error_checks()
-        self.__setup_columns()
 
+        # Independent Oracle reads, each on a pooled session of its own.
+        def load_ontology():
+            with self.oracle.session() as con:
+                return cassava_ontology.CassavaOntology(con.cursor())
+        def load_columns():
+            with self.oracle.session() as con:
+                self.__setup_columns(con.cursor())
+        jobs = [load_ontology, load_columns]
+        self.onto = utility.parallel_map(lambda job: job(), jobs)[0]
 
     def __error_checks(self):
         msg = 'TableGuru: Mandatory {0} not found: {1}'
@@ -90,22 +189,21 @@ class TableGuru(utility.VerboseQuiet):
         if not self.dataset in [i.name for i in self.chado.get_project()]:
             raise RuntimeError(msg.format('project/dataset', chado_dataset))
 
-    def __setup_columns(self):
+    def __setup_columns(self, cursor):
         if not TableGuru.COLUMNS:
+            cache = column_cache.shared()
+            cache.validate(cursor, TableGuru.ALL_TABLES)
             for table in TableGuru.ALL_TABLES:
-                self.c.execute(
-                    OSQL.get_column_metadata_from.format(table=table)
-                )
-                TableGuru.COLUMNS[table] = [
-                    line[1] for line in self.c.fetchall()
-                ]
+                TableGuru.COLUMNS[table] = cache.columns(cursor, table)
                 msg = '[+] TableGuru.COLUMNS[{table}] = {res}'
                 msg = msg.format(table=table,
                                  res=str(self.COLUMNS[table])[:30]+"... ]")
                 self.vprint(msg)
 
     def __tostr(self, d):
-        '''Formatting helper'''
+        '''Formatting helper, mostly Oracledb did the work already.'''
+        if type(d) is str:
+            return d
         if d == None:
             return ''
         if type(d) is datetime.datetime:
@@ -166,30 +264,11 @@ class TableGuru(utility.VerboseQuiet):
     def get_config(self, chado_table=None, oracle_column=None):
         '''Returns only the (TRANS, TRANS_C) config that match the given
         arguments.'''
-        if not self.TRANS or not self.TRANS_C or not hasattr(self, 'tr'):
+        if not self.TRANS or not self.TRANS_C or not hasattr(self, 'tr')\
+                or not hasattr(self, 'translation'):
             self.tr = self.get_translation()
             self.tr_inv = utility.invert_dict(self.tr)
-
-        def fill_with_cond(cond, c=None, o=None):
-            tr = {}
-            ctr = {}
-            t_it = self.tr.iteritems()
-            ct_it = self.TRANS_C.iteritems()
-            [tr.update({k:v}) for k,v in t_it if eval(cond)]
-            [ctr.update({k:v}) for k,v in ct_it if eval(cond)]
-            return tr, ctr
-
-        if chado_table and oracle_column:
-            tr, ctr = fill_with_cond("v.split('.')[0] == c and k == o",
-                                     chado_table, oracle_column)
-        if chado_table:
-            tr, ctr = fill_with_cond("v.split('.')[0] == c", chado_table)
-        elif oracle_column:
-            tr, ctr = fill_with_cond("k == o", oracle_column)
-        else:
-            raise RuntimeError('Must supply either chado_table or oracle_column')
-
-        return tr, ctr
+        return self.translation.config(chado_table, oracle_column)
 
     def create_equal_comparison(self, table, conf, c_conf):
         '''Returns functions to compare oracle objects with chado objects.
@@ -201,45 +280,19 @@ class TableGuru(utility.VerboseQuiet):
         f,f2 = None,None
 
         if table == 'stock':
-            TaskStorage.known_stock_ids = []
-            TaskStorage.unknown_stocks = []
             conf_inv = utility.invert_dict(conf)
             def f(ora, chad):
                 if getattr(ora, conf_inv['stock.name']) != chad.uniquename:
                     return False
                 return True
-            def f2(ora, chads):
-                for c in chads:
-                    if f(ora, c):
-                        # it's equal, lets append its name to known names
-                        TaskStorage.known_stock_ids.append(c.stock_id)
-                        return True
-                ora_stock_name = getattr(ora, conf_inv['stock.name'])
-                if ora_stock_name in TaskStorage.unknown_stocks:
-                    index = TaskStorage.unknown_stocks.index(ora_stock_name)
-                    dup = utility.Duplicate(index)
-                    TaskStorage.known_stock_ids.append(dup)
-                else:
-                    TaskStorage.unknown_stocks.append(ora_stock_name)
-                    TaskStorage.known_stock_ids.append(None)
-                return False
+            # also fills TaskStorage.known_stock_ids and .unknown_stocks
+            f2 = diff_engine.StockMembership(conf_inv['stock.name'])
 
         elif table == 'stockprop':
-            # need to update the mapping every round..
-            stocks = self.chado.get_stock()
-            m = {}
-            for s in stocks: m.update({s.name : s.stock_id})
-            self.map_stock_name_to_id = m
-
-            m = {}
-            sps = self.chado.get_stockprop()
-            cvts = self.chado.get_cvterm()
-            for sp in sps:
-                spname = [i for i in cvts if i.cvterm_id == sp.type_id]
-                assert(len(spname) == 1)
-                spname = spname[0].name
-                m.update({spname : sp.type_id})
-            self.map_stockprop_type_to_cvterm_id = m
+            # kept up to date every round, see create_upload_tasks()
+            self.map_stock_name_to_id = self.chado_index.stock_names
+            self.map_stockprop_type_to_cvterm_id = \
+                self.chado_index.stockprop_types
 
             def f(sp, current):
                 m_stockid = self.map_stock_name_to_id
@@ -253,35 +306,16 @@ class TableGuru(utility.VerboseQuiet):
                     return True
                 return False
 
-            def f2(sp, currents):
-                '''is_in([stock.name, property], [[id1,typ1],[..],..])
-
-                Must be usable like:
-                    ids = [[i.stock_id i.type_id] for i in chado.get_stockprop()]
-                    f([stock,prop_t], ids)
-                        -> True if stock,prop_t is already in ids
-                '''
-                m_stockid = self.map_stock_name_to_id
-                m_propid = self.map_stockprop_type_to_cvterm_id
-                s,p = sp
-                if not m_stockid.has_key(s):
-                    return False
-                if not m_propid.has_key(p):
-                    msg = 'No Key: Mapping(:stock_id => :cvterm_id) "{}"'
-                    raise Warning(msg.format(p))
-                s_id = m_stockid[s]
-                p_id = m_propid[p]
-                if [s_id, p_id] in currents:
-                    return True
-                return False
+            # is_in([stock.name, property], [[id1,typ1],[..],..])
+            f2 = diff_engine.StockpropMembership(
+                self.map_stock_name_to_id,
+                self.map_stockprop_type_to_cvterm_id)
 
         else:
             def f(ora, chad):
                 if chad in ora: return True
                 return False
-            def f2(ora, chads): #set
-                if ora.intersection(chads): return True
-                return False
+            f2 = diff_engine.SetMembership() # is_in(set, set)
 
         return f,f2
 
@@ -338,15 +372,16 @@ class TableGuru(utility.VerboseQuiet):
             if not get_all_func or not callable(get_all_func):
                 msg = 'Chado.{} not found'
                 raise NotImplementedError(msg.format(func_name))
-            current = get_all_func()
+            # Instead of get_all_func(), we ask our index, see
+            # create_upload_tasks().
 
             # Default to non-override
             # Both _override lists are only used for comparison
             data_override = self.data
-            curr_override = current
+            curr_override = self.chado_index.stock_ids
 
             if tab == 'stockprop':
-                curr_override = [[i.stock_id, i.type_id] for i in current]
+                curr_override = self.chado_index.stockprops
                 data_override = []
                 for attr in dir(self.data[0]):
                     if self.tr.has_key(attr) and 'stockprop.' in self.tr[attr]:
@@ -358,18 +393,11 @@ class TableGuru(utility.VerboseQuiet):
             elif tab == 'stock':
                 pass
             else:
-                curr_override = set(p.uniquename for p in self.chado.get_phenotype())
-                def tmp(d):
-                    id = uid(d, self.tr_inv)
-                    mkuniq = chado.ChadoDataLinker.make_pheno_unique #returns set
-                    uniqnames = set(mkuniq(id, t) for t in self.pheno_traits)
-                    return uniqnames
-                data_override = [tmp(d) for d in self.data]
-
-            unknown = []
-            for entry,entry_ovrw in zip(self.data, data_override):
-                if not is_in(entry_ovrw, curr_override) and not entry in unknown:
-                    unknown.append(entry)
+                curr_override = self.chado_index.phenotypes
+                data_override = self.__pheno_uniquenames()
+
+            unknown = diff_engine.unknown_rows(self.data, data_override,
+                                               is_in, curr_override)
         else:
             unknown = self.data
 
@@ -378,6 +406,7 @@ class TableGuru(utility.VerboseQuiet):
             else:   eclass = ThisIsBad
             msg = '[{}] len(unknown) != len(set(unknown))'.format(tab)
             raise eclass(msg)
+        self.counts[tab] = len(unknown)
 
         # Blacklist contains oracle attributes, which we understand according
         # to ontology or configuration, but which don't exist the OracleDB.
@@ -439,7 +468,7 @@ class TableGuru(utility.VerboseQuiet):
         Note that we do a case insensitive comparison while trying to find
         Ontology for a term in <maybe_known>.
         '''
-        all_cvt_names = [i.name for i in self.chado.get_cvterm()]
+        all_cvt_names = set(i.name for i in self.chado.get_cvterm())
         needed_cvts = [i for i in maybe_known if not i in all_cvt_names]
         tasks = []
 
@@ -447,9 +476,7 @@ class TableGuru(utility.VerboseQuiet):
             return []
         needed_onto = []
         for cvt in needed_cvts:
-            it = self.onto.mapping.iteritems()
-            cur = [i[1][0] for i in it if i[1][0].TRAIT_NAME.lower() ==\
-                    cvt.lower()]
+            cur = self.onto.find_traits(cvt)
             if len(cur) == 0:
                 continue
             if len(cur) != 1: # Well crap.
@@ -569,40 +596,22 @@ class TableGuru(utility.VerboseQuiet):
 
         # stocks needs to be passed as aditional argument
         stocks = [getattr(i, self.tr_inv['stock.name']) for i in raw_data]
-        ids = [uid(i, self.tr_inv) for i in raw_data]
-
-        others = []
-        for raw_entry in raw_data:
-            new = {}
-            for k,ora_attr in self.tr_inv.iteritems():
-                if k == 'nd_geolocation.description':
-                    name = getattr(raw_entry,
-                                   self.tr_inv['nd_geolocation.description'])
-                    new.update({'site_name' : name})
-                if 'stockprop' in k:
-                    value = self.__tostr(getattr(raw_entry, ora_attr))
-                    new.update({k : value})
-            others.append(new)
+        ids = self.__uniq_ids(raw_data)
+
+        plan = self.pheno_plan
+        tostr = self.__tostr
+        others = [plan.others(raw_entry, tostr) for raw_entry in raw_data]
 
         # Get the real phenotyping data into position.
-        descs = []
-        attr_blacklist = []
-        for phenos in phenotypic_data:
-            new = {}
-            for k,v in phenos.iteritems():
-                if k in attr_blacklist:
-                    continue
-                t_name = self.__get_trait_name(k)
-                if t_name:
-                    new.update({t_name : v})
-                else:
-                    attr_blacklist.append(k)
-            descs.append(new)
-        if attr_blacklist:
+        descs = [plan.descriptors(phenos) for phenos in phenotypic_data]
+        # only once per table and column
+        if len(plan.blacklist) > self.pheno_reported:
             msg = '[blacklist:{tab}] Consider fixing these entries in the'\
                 + ' config file or the ontology tables:\n'\
                 + '\'\'\'\n{blk}\n\'\'\'\n'
-            self.qprint(msg.format(tab=self.table, blk=attr_blacklist))
+            blk = plan.blacklist[self.pheno_reported:]
+            self.qprint(msg.format(tab=self.table, blk=blk))
+            self.pheno_reported = len(plan.blacklist)
 
         # Note: We create needed cvterms for the descriptors syncronously on
         # Task.execution(), as their numbers are low.
@@ -647,71 +656,527 @@ class TableGuru(utility.VerboseQuiet):
         # And the ontology..
         TableGuru.TRANS[self.table].update(self.onto.get_translation())
 
+        # Compiled only once, unless something changed.
+        tr = TableGuru.TRANS[self.table]
+        compiled = TableGuru.TRANSLATIONS.get(self.table)
+        if not compiled or compiled.trans != tr\
+                or compiled.const != TableGuru.TRANS_C:
+            compiled = translation.Translation(tr, TableGuru.TRANS_C)
+            TableGuru.TRANSLATIONS[self.table] = compiled
+        self.translation = compiled
+
         return TableGuru.TRANS[self.table]
 
+    def __source_query(self):
+        '''Returns (sql, binds) selecting the rows of self.table, we need to
+        look at in this run.
+
+        Unless self.full_resync is set, we only select rows at or above the
+        watermark we saved after the last complete run, see
+        WATERMARK_COLUMNS. The new watermark is taken before we start
+        fetching, so nothing that changes meanwhile is lost, and kept in
+        self.next_watermark until __save_watermark().
+        Watermarks like ORA_ROWSCN only hold for the database they were
+        taken on, so we save its DB_NAME with them, ignore them on any
+        other, and only spread partitions over the hosts of that database,
+        see self.watermark_hosts.
+
+        We only select the columns we translate, see __needed_columns(), and
+        remember them in self.columns, so the rows get formatted accordingly.
+        '''
+        self.columns = self.__needed_columns() or None
+        if self.columns:
+            columns = ', '.join('"{}"'.format(c) for c in self.columns)
+        else:
+            columns = '*'
+
+        col = self.WATERMARK_COLUMNS.get(self.table, DEFAULT_WATERMARK)
+        self.watermark_hosts = None
+        database = None
+        if col in PER_DATABASE_WATERMARKS:
+            database = self.oracle.database()
+            # every partition must read the database of the watermark
+            self.watermark_hosts = [h for h in self.oracle.usable_hosts()
+                                    if self.oracle.database(h) == database]
+        self.oracle.cur.execute(OSQL.get_max.format(col=col, table=self.table))
+        self.next_watermark = (col, self.oracle.cur.fetchone()[0], database)
+        cp = self.checkpoint
+        if cp and cp['watermark'] and cp['watermark'][0] == col \
+                and cp['watermark'][2:] == (database,):
+            # or we would skip what changed below the checkpoint meanwhile
+            self.next_watermark = self.checkpoint['watermark']
+
+        self.watermarks = local_store.LocalStore('watermarks')
+        self.watermarked = False
+        last = self.watermarks.get(self.table)
+        if last and last[0] == col and last[2:] != (database,):
+            msg = '[+] watermark: {0} was taken on {1}, not on {2}'
+            self.vprint(msg.format(col, (last[2:] or ['?'])[0], database))
+            last = None
+        if self.full_resync or not last or last[0] != col or last[1] is None:
+            self.vprint('[+] watermark: none, reading all of ' + self.table)
+            sql = OSQL.get_columns_from.format(columns=columns,
+                                               table=self.table)
+            return sql, {}
+        msg = '[+] watermark: only reading {0} >= {1}'
+        self.vprint(msg.format(col, last[1]))
+        self.watermarked = True
+        # Pseudo columns like ORA_ROWSCN don't pass through subqueries, so
+        # this must be the innermost one.
+        sql = OSQL.get_columns_from_at_or_above_mark
+        sql = sql.format(columns=columns, table=self.table, col=col)
+        return sql, {'mark' : last[1]}
+
+    def __save_watermark(self):
+        '''Remember how far we got, once all rounds have been uploaded.'''
+        if self.next_watermark[1] is None:
+            return
+        with self.lock:
+            # other TableGurus might have saved theirs meanwhile
+            self.watermarks.load()
+            self.watermarks[self.table] = self.next_watermark
+            self.watermarks.save()
+        self.vprint('[+] watermark: saved {0} = {1}'.format(
+                    *self.next_watermark[:2]))
+
+    def __needed_columns(self):
+        '''Returns the Oracle columns of self.table, we translate. These
+        include the unique_id columns.'''
+        attrs = set(k.lstrip('_') for k in self.tr.keys())
+        return [c for c in TableGuru.COLUMNS[self.table]
+                if utility.normalize(c) in attrs]
+
+    def __fingerprint_rounds(self, sql, binds, keys, sizer, after=None):
+        '''Generator over the new or changed rows of <sql>, yielding lists of
+        at most <sizer>.size rows, but only those with keys above <after>, if
+        given.
+
+        Oracle computes a hash over all translated columns of each row, and
+        we only download (unique_id, hash) pairs to compare them with the
+        fingerprints saved after the last complete run. Only the rows, we
+        don't know with this exact hash, are fetched completely.
+        Each column is hashed on its own, and the hashes of up to
+        FINGERPRINT_COLUMNS columns are hashed again, as concatenating the
+        values themselves could exceed the 4000 bytes of a VARCHAR2
+        (ORA-01489). Wider tables get one hash per such group.
+
+        Note that rows with changed values, are detected and counted here,
+        but they still exist in Chado, so they are not updated there.
+        '''
+        cols = [OSQL.hash_column.format(col='"{}"'.format(c), null='0' * 32)
+                for c in self.__needed_columns()]
+        n = FINGERPRINT_COLUMNS
+        hashes = [OSQL.hash_hashes.format(hashes=' || '.join(cols[i:i+n]))
+                  for i in range(0, len(cols), n)]
+        fsql = OSQL.get_fingerprints.format(keys=', '.join(keys),
+                                            hashes=', '.join(hashes),
+                                            sub=sql)
+        self.fingerprint_store = local_store.LocalStore(
+            'fingerprints_' + self.table)
+        known = self.fingerprint_store
+        self.next_fingerprints = {}
+        needed = []
+        changed = 0
+        for chunk in self.oracle.iter_rows(fsql, table=self.table, raw=True,
+                                           binds=binds):
+            for row in chunk:
+                key = tuple(row[:len(keys)])
+                fingerprint = tuple(row[len(keys):])
+                if known.get(key) != fingerprint:
+                    if known.has_key(key):
+                        changed += 1
+                    needed.append(key)
+                self.next_fingerprints[key] = fingerprint
+        msg = '[+] fingerprints: {0} rows, {1} new, {2} changed'
+        self.qprint(msg.format(len(self.next_fingerprints),
+                               len(needed) - changed, changed))
+
+        needed.sort()
+        if after:
+            needed = [k for k in needed if k > tuple(after)]
+        i = 0
+        while i < len(needed):
+            n = sizer.size
+            yield self.oracle.get_by_keys(sql, keys, needed[i:i+n],
+                                          table=self.table, binds=binds,
+                                          columns=self.columns)
+            i += n
+
+    def __save_fingerprints(self):
+        '''Remember the fingerprints, once all rounds have been uploaded.
+
+        If we looked at all rows, i.e. not only those above a watermark,
+        fingerprints of rows, which are gone from Oracle, are dropped.
+        '''
+        if not self.next_fingerprints:
+            return
+        if not self.watermarked:
+            self.fingerprint_store.clear()
+        self.fingerprint_store.update(self.next_fingerprints)
+        self.fingerprint_store.save()
+        self.next_fingerprints = {}
+
+    def __fetch_rounds(self, sizer):
+        '''Generator over the rows of self.table, yielding lists of at most
+        <sizer>.size rows, ordered by the unique_id columns. The size is read
+        again for every round, see round_sizer.'''
+        sql, binds = self.__source_query()
+        keys = self.translation.uniq_attrs
+        uniq_col = ', '.join(keys)
+        # We compare keys in python, as Oracle orders them, which only holds
+        # with the binary NLS_SORT, cx_oracle.Oracledb sets for its sessions.
+        self.oracle.native_columns.update(keys)
+        after = self.checkpoint and self.checkpoint['key']
+        if self.fingerprints:
+            for data in self.__fingerprint_rounds(sql, binds, keys, sizer,
+                                                  after):
+                yield data
+            return
+        # Resuming seeks past the checkpoint, and thus always pages by keyset.
+        paging = 'keyset' if after else self.paging
+        if self.partitions > 1 and not after:
+            # the rounds are not ordered, see __save_checkpoint()
+            self.ordered = False
+            batch = max(sizer.size // self.partitions, 1)
+            rows = self.oracle.iter_partitioned(sql, keys, self.partitions,
+                                                batch=batch, table=self.table,
+                                                binds=binds,
+                                                columns=self.columns,
+                                                hosts=self.watermark_hosts)
+        elif paging == 'stream':
+            chunks = self.oracle.iter_rows(sql + OSQL.order_by,
+                                           batch=sizer.size, table=self.table,
+                                           ord=uniq_col, binds=binds,
+                                           columns=self.columns)
+            rows = chain.from_iterable(chunks)
+        else:
+            rows = None
+        if rows is not None:
+            data = list(islice(rows, sizer.size))
+            while data:
+                yield data
+                data = list(islice(rows, sizer.size))
+            return
+        if after:
+            msg = '[+] resuming {0} after {1}'
+            self.qprint(msg.format(self.table, after))
+            data = self.oracle.get_n_after(sql, sizer.size, keys, after=after,
+                                           table=self.table, binds=binds,
+                                           columns=self.columns)
+        else:
+            data = self.oracle.get_first_n(sql, sizer.size, table=self.table,
+                                           ord=uniq_col, binds=binds,
+                                           columns=self.columns)
+
+        fetched = 0
+        while data:
+            fetched += len(data)
+            if paging == 'keyset':
+                self.__check_keyset(data, keys, after)
+            yield data
+            if paging == 'keyset':
+                after = [getattr(data[-1], k) for k in keys]
+                data = self.oracle.get_n_after(sql, sizer.size, keys,
+                                               after=after, table=self.table,
+                                               binds=binds,
+                                               columns=self.columns)
+            else:
+                data = self.oracle.get_n_more(sql, sizer.size, offset=fetched,
+                                              table=self.table, ord=uniq_col,
+                                              binds=binds,
+                                              columns=self.columns)
+
+    def __check_keyset(self, data, keys, after):
+        '''Keyset paging silently skips or repeats rows, unless the unique_id
+        columns <keys> are NOT NULL and unique, thus the rows of each page
+        must ascend strictly, starting above <after>.'''
+        last = tuple(after) if after else None
+        for d in data:
+            key = tuple(getattr(d, k) for k in keys)
+            if None in key or (last is not None and key <= last):
+                msg = '{0}: keyset paging needs unique and NOT NULL'\
+                    + ' unique_id columns {1}, but got {2}'
+                raise RuntimeError(msg.format(self.table, keys, key))
+            last = key
+
+    def __stage_round(self):
+        '''Hands the keys of the current round to our Chado index, see
+        chado_index.StagedIndex and BloomIndex.'''
+        name_attr = self.tr_inv.get('stock.name')
+        names = set()
+        if name_attr:
+            names = set(getattr(d, name_attr) for d in self.data)
+        phenos = set()
+        for uniquenames in self.__pheno_uniquenames():
+            phenos.update(uniquenames)
+        self.chado_index.stage(names, phenos, self.__prop_types())
+
+    def __round_cache(self):
+        '''Per round cache of what several steps compute from self.data.'''
+        if self.round_cache.get('data') is not self.data:
+            self.round_cache = {'data' : self.data}
+        return self.round_cache
+
+    def __uniq_ids(self, rows=None):
+        '''The uniq_id()s of <rows>, which must be rows of self.data, or of
+        all of self.data, in order. They are computed once per round.'''
+        cache = self.__round_cache()
+        if not cache.has_key('ids'):
+            ids = self.translation.uniq_ids(self.data)
+            cache['ids'] = ids
+            cache['ids_by_row'] = dict(zip(map(id, self.data), ids))
+        if rows is None:
+            return cache['ids']
+        by_row = cache['ids_by_row']
+        return [by_row[id(r)] for r in rows]
+
+    def __pheno_uniquenames(self):
+        '''For each row of self.data, the set() of its phenotype
+        uniquenames, see chado.ChadoDataLinker.make_pheno_unique().'''
+        cache = self.__round_cache()
+        if not cache.has_key('phenos'):
+            mkuniq = chado.ChadoDataLinker.make_pheno_unique
+            traits = self.pheno_traits
+            cache['phenos'] = [set(mkuniq(i, t) for t in traits)
+                               for i in self.__uniq_ids()]
+        return cache['phenos']
+
+    def __prop_types(self):
+        '''The stockprop types (cvterm names), self.table translates to.'''
+        return [v[len('stockprop.'):] for v in self.tr.itervalues()
+                if v.startswith('stockprop.')]
+
+    def __rounds(self, sizer):
+        '''Generator over the rounds of self.table, like __fetch_rounds(),
+        but replayed from, or written to self.snapshot_dir, if set. Replayed
+        rounds keep the size they were written with.'''
+        if self.replay:
+            reader = snapshot.SnapshotReader(self.snapshot_dir, self.table)
+            self.vprint('[+] replaying {0} rows'.format(len(reader)))
+            start = self.checkpoint['round'] + 1 if self.checkpoint else 0
+            for data in reader.rounds(start=start):
+                yield data
+            return
+        writer = None
+        if self.snapshot_dir and self.checkpoint:
+            self.qprint('[-] not writing a snapshot of a resumed run')
+        elif self.snapshot_dir:
+            writer = snapshot.SnapshotWriter(self.snapshot_dir, self.table)
+        for data in self.__fetch_rounds(sizer):
+            if writer:
+                writer.write(data)
+            yield data
+        if writer:
+            writer.finish()
+
+    def extract(self, max_round_fetch=600000):
+        '''Only writes a snapshot of self.table to self.snapshot_dir, to be
+        replayed later. No watermarks or fingerprints are saved, as nothing
+        is uploaded.
+
+        The snapshot always holds all rows, i.e. we neither apply saved
+        watermarks nor fingerprints, as a replay must not depend on what
+        was uploaded before the extraction.'''
+        if not self.snapshot_dir or self.replay:
+            raise RuntimeError('extract() needs a <snapshot_dir> and no'\
+                               + ' <replay>')
+        self.tr = self.get_translation()
+        self.tr_inv = utility.invert_dict(self.tr)
+        fetched = 0
+        sizer = round_sizer.FixedSize(max_round_fetch)
+        full_resync, fingerprints = self.full_resync, self.fingerprints
+        self.full_resync, self.fingerprints = True, False
+        self.checkpoint = None
+        try:
+            for data in self.__rounds(sizer):
+                fetched += len(data)
+        finally:
+            self.full_resync, self.fingerprints = full_resync, fingerprints
+        msg = '[+] snapshot of {0}: {1} rows'
+        self.qprint(msg.format(self.table, fetched))
+
+    def __load_checkpoint(self):
+        '''Returns the checkpoint of self.table to resume from, or None, if
+        we start over. Unless resuming, the old checkpoint is dropped.'''
+        if not self.resume:
+            self.__drop_checkpoint()
+            return None
+        cp = self.checkpoints.get(self.table)
+        if not cp:
+            self.qprint('[+] no checkpoint of {0}'.format(self.table))
+            return None
+        if cp['replay'] != self.replay:
+            msg = '[-] checkpoint of {0} is from a {1} run, starting over'
+            kind = 'replay' if cp['replay'] else 'non-replay'
+            self.qprint(msg.format(self.table, kind))
+            return None
+        if cp['key'] is None and not self.replay:
+            msg = '[-] checkpoint of {0} has no key, as its rounds were'\
+                + ' unordered (partitions), starting over'
+            self.qprint(msg.format(self.table))
+            return None
+        msg = '[+] checkpoint of {0}: round {1}, {2} rows, {3}'
+        self.qprint(msg.format(self.table, cp['round'], cp['rows'],
+                               cp['time']))
+        return cp
+
+    def __save_checkpoint(self, round_N, fetched):
+        '''Remembers that round <round_N> is uploaded, with <fetched> rows so
+        far, so a later run with <resume> continues after the unique_id of
+        its last row. Called holding self.lock.
+
+        Hash-partitioned rounds are not ordered, so we cannot tell which rows
+        come after them, and don't save a key.
+        '''
+        key = None
+        if self.ordered and self.data:
+            key = [getattr(self.data[-1], k)
+                   for k in self.translation.uniq_attrs]
+        self.checkpoints.load()
+        self.checkpoints[self.table] = {
+            'round' : round_N,
+            'rows' : fetched,
+            'key' : key,
+            'counts' : self.counts,
+            'watermark' : getattr(self, 'next_watermark', None),
+            'replay' : self.replay,
+            'time' : time.ctime(),
+        }
+        self.checkpoints.save()
+
+    def __drop_checkpoint(self):
+        with self.lock:
+            self.checkpoints.load()
+            if self.checkpoints.pop(self.table, None):
+                self.checkpoints.save()
+
     def create_upload_tasks(self, max_round_fetch=600000, test=None):
         '''Multiplexer for the single rake_{table} functions.
 
         Each create necessary workbooks for the specified table, save them and
         returns all their names in an array.
         '''
-        msg = '[create_upload_tasks] max_round_fetch={0}, test={1}'
-        self.vprint(msg.format(max_round_fetch, test))
+        msg = '[create_upload_tasks] max_round_fetch={0}, test={1},'\
+            + ' paging={2}, partitions={3}'
+        self.vprint(msg.format(max_round_fetch, test, self.paging,
+                               self.partitions))
         self.tr = self.get_translation()
         self.tr_inv = utility.invert_dict(self.tr)
 
+        # How to transform the phenotypes of each row, see
+        # __check_and_add_phenotypes().
+        self.pheno_plan = translation.PhenotypePlan(self.translation,
+                                                    self.__get_trait_name)
+        self.pheno_reported = 0
         self.pheno_traits = []
         for ora,chad in self.tr.iteritems():
             if 'phenotype.value' == chad:
-                self.pheno_traits.append(self.__get_trait_name(ora))
+                self.pheno_traits.append(self.pheno_plan.trait(ora))
 
         if test and (test < max_round_fetch):
             max_round_fetch = test
+        if self.round_min:
+            high = self.round_max or max_round_fetch
+            if test:
+                high = min(high, test)
+            low = min(self.round_min, high)
+            # nothing measured yet, so <max_rss> can't protect a big start
+            self.sizer = round_sizer.RoundSizer(low, low, high,
+                                                max_rss=self.max_rss)
+            log_size = self.qprint
+        else:
+            self.sizer = round_sizer.FixedSize(max_round_fetch)
+            log_size = self.vprint
+
+        self.checkpoints = local_store.LocalStore('checkpoints')
+        self.checkpoint = self.__load_checkpoint()
+        self.ordered = True
 
-        sql = OSQL.get_all_from
-        primary_key_columns = uid(None, self.tr_inv, only_attrs=True)
-        uniq_col = ', '.join(primary_key_columns)
-        self.data = self.oracle.get_first_n(sql, max_round_fetch,
-                                            table=self.table, ord=uniq_col)
+        # What exists in Chado, caught up under the lock before diffing each
+        # round, the first one included, as other TableGurus might upload
+        # meanwhile.
+        with self.lock:
+            self.chado_index.load(prop_types=self.__prop_types())
+
+        # Only the fetching runs ahead, diffing a round needs the uploads of
+        # the ones before it, see chado_index.
+        rounds = self.__rounds(self.sizer)
+        if self.pipeline:
+            rounds = utility.prefetch(rounds, self.pipeline)
 
         round_N = -1
         fetched = 0
-        while True:
-            round_N += 1
-            fetched_cur = len(self.data)
-            fetched += fetched_cur
-            msg = '[+] === upload round {} ({}) ==='
-            self.vprint(msg.format(round_N, time.ctime()))
-
-            t = {}
-
-            t.update({'stocks' : self.__check_and_add_stocks()})
-            t.update({'stockprops' : self.__check_and_add_stockprops()})
-            t.update({'sites' : self.__check_and_add_sites()})
-            t.update({'contacts' : self.__check_and_add_contacts()})
-            t.update({'phenos' : self.__check_and_add_phenotypes()})
-
-            # Replace None values with dummies.
-            for k,v in t.iteritems():
-                if v is None:
-                    self.vprint('[-] None-Task for {}'.format(k))
-                    t[k] = utility.Task.init_empty()
-
-            # the tasks variable is explained in migration.py -> Task.parallel_upload
-            tasks = (
-                [ t['stocks'], t['sites'], t['contacts'], ],
-                [ t['phenos'], t['stockprops'] ],
-            )
-            yield tasks
-
-            if test and fetched >= test:
-                break
-            self.data = self.oracle.get_n_more(sql, max_round_fetch,
-                                               offset=fetched,
-                                               table=self.table,
-                                               ord=uniq_col)
-            if not self.data:
-                break
+        if self.checkpoint:
+            round_N = self.checkpoint['round']
+            fetched = self.checkpoint['rows']
+        self.sizer.start()
+        mark = time.time()
+        try:
+            for self.data in rounds:
+                fetch_s = time.time() - mark
+                start = time.time()
+                round_N += 1
+                fetched_cur = len(self.data)
+                fetched += fetched_cur
+                msg = '[+] === upload round {} ({}) ==='
+                self.vprint(msg.format(round_N, time.ctime()))
+
+                # Held until the upload of this round is done, i.e. we are
+                # resumed, as TaskStorage is global, and other TableGurus must
+                # not diff against a Chado we are about to change.
+                with self.lock:
+                    self.chado_index.refresh()
+
+                    t = {}
+                    self.counts = {}
+
+                    if self.chado_index.STAGED:
+                        self.__stage_round()
+                    t.update({'stocks' : self.__check_and_add_stocks()})
+                    t.update({'stockprops' : self.__check_and_add_stockprops()})
+                    t.update({'sites' : self.__check_and_add_sites()})
+                    t.update({'contacts' : self.__check_and_add_contacts()})
+                    t.update({'phenos' : self.__check_and_add_phenotypes()})
+
+                    # Replace None values with dummies.
+                    for k,v in t.iteritems():
+                        if v is None:
+                            self.vprint('[-] None-Task for {}'.format(k))
+                            t[k] = utility.Task.init_empty()
+
+                    # the tasks variable is explained in migration.py -> Task.parallel_upload
+                    tasks = (
+                        [ t['stocks'], t['sites'], t['contacts'], ],
+                        [ t['phenos'], t['stockprops'] ],
+                    )
+                    diffed = time.time()
+                    yield tasks
+                    uploaded = time.time()
+                    self.__save_checkpoint(round_N, fetched)
+
+                # With a pipeline, the next rounds are being fetched already, so
+                # a new size only applies to the ones after them.
+                self.sizer.observe(fetched_cur, fetch_s, diffed - start,
+                                   uploaded - diffed)
+                msg = '[+] round {0}: {1} rows, fetch {2:.1f}s, diff {3:.1f}s,'\
+                    + ' upload {4:.1f}s, rss {5} MB => next {6} rows'
+                log_size(msg.format(round_N, fetched_cur, fetch_s,
+                                    diffed - start, uploaded - diffed,
+                                    round_sizer.rss() // 2**20,
+                                    self.sizer.size))
+                self.sizer.start()
+                mark = time.time()
+
+                if test and fetched >= test:
+                    break
+            else:
+                if not self.replay:
+                    self.__save_watermark()
+                    self.__save_fingerprints()
+                self.__drop_checkpoint()
+        finally:
+            # also if we fail, or are closed early, see StagedIndex.close()
+            self.chado_index.close()
         self.vprint('[+] === the end ({}) ==='.format(time.ctime()))
 
 # Just fill in some empty dict()'s.
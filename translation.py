@@ -0,0 +1,110 @@
+'''
+Compiled Oracle -> Chado translation (see trans.conf) of a single table.
+
+TableGuru keeps the parsed config as plain dict()s, mapping Oracle columns
+to 'chado_table.field' names. We index those once per table, so looking up
+the part, which concerns one Chado table or one Oracle column, is a single
+dict() access.
+'''
+import utility
+
+class Translation(object):
+    '''Usage:
+        t = Translation(TableGuru.TRANS[table], TableGuru.TRANS_C)
+        tr, c_tr = t.config(chado_table='stock')
+        t.uniq_attrs            # -> ['ENSAYO', 'REPETICION', 'VARIEDAD']
+        t.uniq_id(row)          # -> 'E1_2_V3'
+        t.uniq_ids(rows)        # -> [t.uniq_id(row) for row in rows]
+    '''
+
+    def __init__(self, trans, const):
+        '''<trans> maps Oracle columns to Chado fields, <const> constant
+        relationships to Chado fields (TableGuru.TRANS_C).'''
+        self.trans = dict(trans)
+        self.const = dict(const)
+        self.inv = utility.invert_dict(self.trans)
+
+        self.by_table = {}  # chado table   -> (trans, const)
+        self.by_column = {} # oracle column -> (trans, const)
+        self.by_both = {}   # (chado table, oracle column) -> (trans, const)
+        for i,d in enumerate([self.trans, self.const]):
+            for k,v in d.iteritems():
+                table = v.split('.')[0]
+                for index,key in [(self.by_table, table),
+                                  (self.by_column, k),
+                                  (self.by_both, (table, k))]:
+                    index.setdefault(key, ({}, {}))[i][k] = v
+
+        # see trans.conf for the leading '_'
+        self.uniq_attrs = utility.get_uniq_id(None, self.inv, only_attrs=True)
+        # Same as utility.get_uniq_id(entry, self.inv).
+        self.uniq_id = utility.uniq_id_extractor(self.inv)
+
+    def config(self, chado_table=None, oracle_column=None):
+        '''Returns the (trans, const) parts matching the given arguments. The
+        dict()s are shared, don't modify them.'''
+        if chado_table and oracle_column:
+            index, key = self.by_both, (chado_table, oracle_column)
+        elif chado_table:
+            index, key = self.by_table, chado_table
+        elif oracle_column:
+            index, key = self.by_column, oracle_column
+        else:
+            raise RuntimeError('Must supply either chado_table or oracle_column')
+        return index.get(key, ({}, {}))
+
+    def uniq_ids(self, entries):
+        '''The uniq_id()s of all <entries>, in one pass.'''
+        return map(self.uniq_id, entries)
+
+class PhenotypePlan(object):
+    '''What TableGuru.__check_and_add_phenotypes() does with each row, worked
+    out once per table, instead of for every key of every row.
+
+    Usage:
+        plan = PhenotypePlan(t, trait_name)
+        plan.trait('ALTURA')            # -> 'Plant height', '' if unknown
+        plan.descriptors(phenos)        # -> {trait name : value, ..}
+        plan.others(row, tostr)         # -> {'site_name' : .., 'stockprop.x' : ..}
+        plan.blacklist                  # -> columns without a trait name
+    '''
+
+    def __init__(self, trans, trait_name):
+        '''<trans> is a Translation, <trait_name>(oracle column) returns the
+        ontology's trait name, or an empty string.'''
+        self.trait_name = trait_name
+        self.traits = {} # oracle column -> trait name, resolved on first use
+        self.blacklist = []
+        self.site_attr = trans.inv.get('nd_geolocation.description')
+        self.props = [(k, ora_attr) for k,ora_attr in trans.inv.iteritems()
+                      if 'stockprop' in k]
+
+    def trait(self, column):
+        name = self.traits.get(column)
+        if name is None:
+            name = self.traits[column] = self.trait_name(column)
+            if not name:
+                self.blacklist.append(column)
+        return name
+
+    def descriptors(self, phenos):
+        '''Maps the oracle columns of <phenos> to their trait names, dropping
+        those without.'''
+        new = {}
+        for k,v in phenos.iteritems():
+            name = self.traits.get(k)
+            if name is None:
+                name = self.trait(k)
+            if name:
+                new[name] = v
+        return new
+
+    def others(self, row, tostr):
+        '''The site name and the stockprops of <row>, formatted by
+        <tostr>.'''
+        new = {}
+        if self.site_attr:
+            new['site_name'] = getattr(row, self.site_attr)
+        for k,ora_attr in self.props:
+            new[k] = tostr(getattr(row, ora_attr))
+        return new
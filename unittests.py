@@ -5,11 +5,21 @@ import traceback
 from unittest_helper import PostgreRestorer as PGR
 import chado
 import os
+import cPickle
 import cx_oracle
 import cassava_ontology
 import getpass
 import migration
 import table_guru
+import translation
+import round_sizer
+import snapshot
+import tempfile
+import shutil
+import bloom_filter
+import diff_engine
+import bench_diff
+from task_storage import TaskStorage
 
 # Half-Global connections to speed things up a lot.
 # Note that the other test will use these connections.
@@ -384,6 +394,205 @@ class UtilityTests(unittest.TestCase):
         self.assertEqual(utility.uniq(d, key=lambda x: x[0]), d)
         self.assertNotEqual(utility.uniq(d, key=lambda x: x[1]), d)
 
+    def test_uniq_unhashable(self):
+        a = [{'a' : 1}, {'a' : 1}, {'a' : [1]}, {'a' : [1]}, [2]]
+        self.assertEqual(utility.uniq(a), [{'a' : 1}, {'a' : [1]}, [2]])
+
+    def test_row_layouts(self):
+        h, data = ['A', 'B_C'], [(1, 'x'), (2, 'y')]
+        rows = utility.make_namedtuple_with_headers(h, 'T', data)
+        self.assertEqual([r.B_C for r in rows], ['x', 'y'])
+        again = utility.make_namedtuple_with_headers(h, 'T', data)
+        self.assertIs(type(rows[0]), type(again[0]))
+        rows = utility.make_namedtuple_with_headers(h, 'T', data, 'tuple')
+        self.assertEqual(rows, data)
+        self.assertEqual(rows.get(rows[1], 'A'), 2)
+        rows = utility.make_namedtuple_with_headers(h, 'T', data, 'columns')
+        self.assertEqual(rows['B_C'], ['x', 'y'])
+        self.assertEqual(len(rows), 2)
+
+    def test_translation(self):
+        tr = {'ENSAYO' : 'unique_id_1', '_VARIEDAD' : 'unique_id_2',
+              'VARIEDAD' : 'stock.name', 'FECHA' : 'stockprop.plant_date'}
+        t = translation.Translation(tr, {'ORG' : 'stock.organism_id'})
+        self.assertEqual(t.config(chado_table='stock'),
+                         ({'VARIEDAD' : 'stock.name'},
+                          {'ORG' : 'stock.organism_id'}))
+        self.assertEqual(t.config(oracle_column='FECHA'),
+                         ({'FECHA' : 'stockprop.plant_date'}, {}))
+        self.assertEqual(t.config(chado_table='nd_geolocation'), ({}, {}))
+        self.assertEqual(t.uniq_attrs, ['ENSAYO', 'VARIEDAD'])
+        entry = utility.make_namedtuple_with_headers(['ENSAYO', 'VARIEDAD'],
+                                                     'T', [('E1', 'V3')])[0]
+        self.assertEqual(t.uniq_id(entry), 'E1_V3')
+        self.assertEqual(t.uniq_id(entry),
+                         utility.get_uniq_id(entry, t.inv))
+        self.assertEqual(t.uniq_ids([entry, entry]), ['E1_V3', 'E1_V3'])
+        one = utility.uniq_id_extractor({'unique_id_1' : 'ENSAYO'})
+        self.assertEqual(one(entry), 'E1')
+
+    def test_phenotype_plan(self):
+        tr = {'ENSAYO' : 'unique_id_1', 'SITIO' : 'nd_geolocation.description',
+              'FECHA' : 'stockprop.plant_date', 'ALTURA' : 'phenotype.value',
+              'RARO' : 'phenotype.value'}
+        t = translation.Translation(tr, {})
+        names = {'ALTURA' : 'height'}
+        plan = translation.PhenotypePlan(t, lambda c: names.get(c, ''))
+        self.assertEqual(plan.descriptors({'ALTURA' : 3, 'RARO' : 1}),
+                         {'height' : 3})
+        self.assertEqual(plan.blacklist, ['RARO'])
+        row = utility.make_namedtuple_with_headers(['SITIO', 'FECHA'], 'T',
+                                                   [('S1', 20)])[0]
+        self.assertEqual(plan.others(row, str),
+                         {'site_name' : 'S1', 'stockprop.plant_date' : '20'})
+
+    def test_keyset_condition(self):
+        cond, binds = utility.keyset_condition(['A', 'B'], [1, 'x'])
+        self.assertEqual(binds, {'k0' : 1, 'k1' : 'x'})
+        self.assertEqual(cond, 'A >= :k0 AND ((A > :k0) OR (A = :k0 AND'\
+                               + ' B > :k1))')
+
+    def test_keys_in_condition(self):
+        cond, binds = utility.keys_in_condition(['A', 'B'], [[1, 'x'],
+                                                             [2, 'y']])
+        self.assertEqual(cond, '(A, B) IN ((:v0_0, :v0_1), (:v1_0, :v1_1))')
+        self.assertEqual(binds, {'v0_0' : 1, 'v0_1' : 'x',
+                                 'v1_0' : 2, 'v1_1' : 'y'})
+
+    def test_prefetch(self):
+        def gen():
+            for i in range(5):
+                yield i
+            raise ValueError('end')
+        items = []
+        with self.assertRaises(ValueError):
+            for i in utility.prefetch(gen(), depth=2):
+                items.append(i)
+        self.assertEqual(items, range(5))
+        self.assertEqual(list(utility.prefetch(iter([]), depth=3)), [])
+        self.assertEqual(list(utility.prefetch([1, 2], depth=0)), [1, 2])
+
+        def slow():
+            import time
+            for i in range(10):
+                time.sleep(0.01)
+                yield i
+        src = slow()
+        items = utility.prefetch(src, depth=2)
+        next(items)
+        items.close()
+        self.assertFalse(src.gi_running)
+        self.assertIn(next(src), [1, 2, 3])
+
+    def test_parallel_upload_raises(self):
+        done = []
+        def fail():
+            raise ValueError('upload failed')
+        tasks = ([utility.Task('ok', lambda: done.append(1)),
+                  utility.Task('fail', fail)],
+                 utility.Task('never', lambda: done.append(2)))
+        with self.assertRaises(ValueError):
+            utility.Task.parallel_upload(tasks)
+        self.assertEqual(done, [1])
+
+    def test_tuple_rows(self):
+        rows = utility.make_namedtuple_with_headers(['A', 'B'], 'T',
+                                                    [(1, 2), (3, 4)],
+                                                    layout='tuple')
+        self.assertEqual(rows.field_index, {'A' : 0, 'B' : 1})
+        self.assertEqual(rows.get(rows[1], 'B'), 4)
+        self.assertEqual(rows.index((3, 4)), 1) # still a list
+
+    def test_snapshot(self):
+        d = tempfile.mkdtemp()
+        try:
+            rounds = [utility.make_namedtuple_with_headers(
+                          ['A', 'B'], 'T', [(i, 'b{}'.format(i))
+                                            for i in range(j, j + 3)])
+                      for j in (0, 3)]
+            w = snapshot.SnapshotWriter(d, 'T')
+            for rows in rounds:
+                w.write(rows)
+            # not complete yet
+            self.assertRaises(RuntimeError, snapshot.SnapshotReader, d, 'T')
+            w.finish()
+            r = snapshot.SnapshotReader(d, 'T')
+            self.assertEqual(len(r), 6)
+            self.assertEqual(list(r.rounds()), rounds)
+            self.assertEqual(list(r.rounds(start=1)), rounds[1:])
+            self.assertEqual(r.rounds().next()[0].B, 'b0')
+        finally:
+            shutil.rmtree(d)
+
+    def test_diff_engine(self):
+        rows, chads = bench_diff.make_data(50)
+        rows.append(rows[1]) # a new stock again, i.e. a Duplicate
+        old = bench_diff.old_diff(rows, chads)
+        old_ids = TaskStorage.known_stock_ids
+        old_unknown = TaskStorage.unknown_stocks
+        new = bench_diff.new_diff(rows, chads)
+        self.assertEqual(new, old)
+        self.assertEqual(TaskStorage.unknown_stocks, old_unknown)
+        # Duplicate markers point at the same unknown stock
+        self.assertEqual([getattr(i, 'index', i)
+                          for i in TaskStorage.known_stock_ids],
+                         [getattr(i, 'index', i) for i in old_ids])
+        self.assertTrue(any(isinstance(i, utility.Duplicate)
+                            for i in TaskStorage.known_stock_ids))
+
+        is_in = diff_engine.StockpropMembership({'a' : 1, 'b' : 2},
+                                                {'p' : 7})
+        known = [[1, 7]]
+        self.assertTrue(is_in(['a', 'p'], known))
+        self.assertFalse(is_in(['b', 'p'], known))
+        self.assertFalse(is_in(['c', 'p'], known))
+        is_in = diff_engine.SetMembership()
+        self.assertTrue(is_in(set(['x', 'y']), ['y']))
+        self.assertFalse(is_in(set(['x']), ['y']))
+
+    def test_round_sizer(self):
+        sizer = round_sizer.RoundSizer(100, 10, 300)
+        sizer.observe(100, 1, 0, 0)
+        self.assertEqual(sizer.size, 150)
+        sizer.observe(150, 0.5, 0.5, 0)     # faster, keep growing
+        self.assertEqual(sizer.size, 225)
+        sizer.observe(225, 1, 1, 8)         # slower, turn around
+        self.assertEqual(sizer.size, 183)
+        sizer.observe(183, 1, 1, 8)         # slower, turn with a smaller step
+        self.assertEqual(sizer.size, 202)
+        sizer = round_sizer.RoundSizer(1000, 10, 300)
+        self.assertEqual(sizer.size, 300)
+
+        used = [1000]
+        rss, round_sizer.rss = round_sizer.rss, lambda: used[0]
+        try:
+            sizer = round_sizer.RoundSizer(100, 10, 300, max_rss=2000)
+            sizer.start()
+            used[0] = 1500                  # 5 per row, room for 200
+            sizer.observe(100, 1, 0, 0)
+            self.assertEqual(sizer.size, 150)
+            sizer.start()
+            used[0] = 2250                  # still 5 per row, room for 100
+            sizer.observe(150, 1, 0, 0)
+            self.assertEqual(sizer.size, 100)
+            sizer.start()                   # above max_rss, don't grow
+            sizer.observe(100, 0.1, 0, 0)
+            self.assertEqual(sizer.size, 100)
+        finally:
+            round_sizer.rss = rss
+
+    def test_bloom_filter(self):
+        f = bloom_filter.BloomFilter(1000, 0.01)
+        names = ['pheno {}'.format(i) for i in range(1000)]
+        f.update(names)
+        self.assertTrue(all(n in f for n in names))
+        self.assertTrue(u'pheno 1' in f)
+        false = sum(1 for i in range(10000) if 'other {}'.format(i) in f)
+        self.assertLess(false, 300)
+        self.assertFalse(f.full())
+        g = cPickle.loads(cPickle.dumps(f, cPickle.HIGHEST_PROTOCOL))
+        self.assertTrue(all(n in g for n in names))
+
 
 def run():
     ts = unittest.TestSuite()
@@ -14,8 +14,14 @@ monkey.patch_all() # Needs to be executed before threading, because the
                    # index value, which will lead to a crash, once we search
                    # for the index of the main thread.
 
+import sys
 import threading
-from collections import namedtuple
+import gc
+from gevent.threadpool import ThreadPool
+from collections import namedtuple, deque
+from contextlib import contextmanager
+from functools import partial
+from operator import attrgetter
 from re import sub
 
 class Duplicate():
@@ -36,6 +42,49 @@ def get_uniq_id(entry, trans, only_attrs=False):
     if only_attrs: return attr
     return '_'.join(str(getattr(entry, a)) for a in attr)
 
+def uniq_id_extractor(trans):
+    '''Returns f(entry), which is get_uniq_id(entry, <trans>), but with the
+    attributes looked up once, instead of for every entry.'''
+    attr = get_uniq_id(None, trans, only_attrs=True)
+    if not attr:
+        return lambda entry: ''
+    get = attrgetter(*attr)
+    if len(attr) == 1:
+        return lambda entry: str(get(entry))
+    join = '_'.join
+    return lambda entry: join(map(str, get(entry)))
+
+def keyset_condition(keys, after):
+    '''Returns (condition, binds) selecting all rows ordered after the key
+    tuple <after>, when ordered by the columns <keys>.
+
+    Oracle does not compare row values, so we expand (a, b) > (x, y) to:
+        a >= :k0 AND (a > :k0 OR (a = :k0 AND b > :k1))
+    The leading '>=' lets Oracle use an index range scan on <keys>.
+    '''
+    binds = dict(('k{}'.format(i), v) for i,v in enumerate(after))
+    ors = []
+    for i,k in enumerate(keys):
+        conds = ['{0} = :k{1}'.format(keys[j], j) for j in range(i)]
+        conds.append('{0} > :k{1}'.format(k, i))
+        ors.append('(' + ' AND '.join(conds) + ')')
+    cond = '{0} >= :k0 AND ({1})'.format(keys[0], ' OR '.join(ors))
+    return cond, binds
+
+def keys_in_condition(keys, values):
+    '''Returns (condition, binds) selecting the rows, whose <keys> columns
+    equal one of the key tuples in <values>:
+        (a, b) IN ((:v0_0, :v0_1), (:v1_0, :v1_1), ..)
+    '''
+    binds = {}
+    tuples = []
+    for i,value in enumerate(values):
+        names = ['v{0}_{1}'.format(i, j) for j in range(len(keys))]
+        binds.update(zip(names, value))
+        tuples.append('(' + ', '.join(':' + n for n in names) + ')')
+    cond = '({0}) IN ({1})'.format(', '.join(keys), ', '.join(tuples))
+    return cond, binds
+
 def make_namedtuple_with_query(cursor, query, name, data):
     '''Return <data> as a named tuple, called <name>.
     
@@ -52,12 +101,78 @@ def make_namedtuple_with_query(cursor, query, name, data):
     headers = [normalize(i[1]) for i in cursor.fetchall()]
     return make_namedtuple_with_headers(headers, name, data)
 
-def make_namedtuple_with_headers(headers, name, data):
-    # we might get non-uniq headers here
-    # TODO find out what happened
-    NTuple = namedtuple(name, uniq(headers)) 
-    result = [NTuple(*r) for r in data]
-    return result
+# (name, headers) -> namedtuple class, see row_class()
+_ROW_CLASSES = {}
+# Row formats of make_namedtuple_with_headers()
+ROW_LAYOUTS = ['namedtuple', 'tuple', 'columns']
+
+def row_class(name, headers):
+    '''Returns the namedtuple class called <name> with fields <headers>,
+    which is only created once per process.'''
+    key = (name, tuple(headers))
+    cls = _ROW_CLASSES.get(key)
+    if cls is None:
+        # we might get non-uniq headers here
+        # TODO find out what happened
+        cls = _ROW_CLASSES.setdefault(key, namedtuple(name, uniq(headers)))
+    return cls
+
+class TupleRows(list):
+    '''A list of plain tuples, with the column positions in .field_index,
+    e.g.:
+        rows.field_index['COL'] -> 3
+        rows.get(rows[0], 'COL')
+    '''
+    def __init__(self, headers, data):
+        super(TupleRows, self).__init__(data)
+        self.fields = uniq(headers)
+        self.field_index = dict((h, i) for i,h in enumerate(self.fields))
+    def get(self, row, attr):
+        return row[self.field_index[attr]]
+
+class ColumnRows(dict):
+    '''The rows as one list per column, e.g. rows['COL'][0].'''
+    def __init__(self, headers, data):
+        super(ColumnRows, self).__init__()
+        self.fields = uniq(headers)
+        columns = zip(*data) or [()] * len(self.fields)
+        for h,c in zip(self.fields, columns):
+            self[h] = list(c)
+    def __len__(self):
+        return len(self[self.fields[0]]) if self.fields else 0
+
+@contextmanager
+def gc_paused():
+    '''with gc_paused(): ...  ,without the cyclic garbage collector, which
+    otherwise runs over and over again, while we allocate lots of rows (that
+    can't be part of any cycle anyway).'''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def make_namedtuple_with_headers(headers, name, data, layout='namedtuple'):
+    '''Returns the list of tuples <data> as a list of namedtuples called
+    <name>, see row_class(). Other <layout>s are TupleRows and ColumnRows,
+    which keep no object per row besides the plain tuple, or none at all.
+    '''
+    with gc_paused():
+        if layout == 'namedtuple':
+            cls = row_class(name, headers)
+            if data and len(data[0]) != len(cls._fields):
+                msg = 'expected {0} values per row, got {1}'
+                raise TypeError(msg.format(len(cls._fields), len(data[0])))
+            # like cls._make, but without checking each row
+            return map(partial(tuple.__new__, cls), data)
+        elif layout == 'tuple':
+            return TupleRows(headers, data)
+        elif layout == 'columns':
+            return ColumnRows(headers, data)
+    msg = 'unknown row layout: {0}, must be in {1}'
+    raise RuntimeError(msg.format(layout, ROW_LAYOUTS))
 
 def normalize(s):
     '''Some string substitutions, to make it a valid Attribute.
@@ -78,15 +193,34 @@ class OracleSQLQueries():
             WHERE table_name = '{table}'
             ORDER BY COLUMN_ID\
     '''
+    get_ddl_stamps = '''\
+        SELECT o.object_name, o.last_ddl_time, COUNT(c.column_name)
+            FROM USER_OBJECTS o
+            LEFT JOIN USER_TAB_COLUMNS c ON c.table_name = o.object_name
+            WHERE o.object_name IN ({tables})
+            GROUP BY o.object_name, o.object_type, o.last_ddl_time\
+    '''
     get_all_from = '''\
         SELECT * FROM {table}\
     '''
+    get_row_count = '''\
+        (SELECT COUNT(*) FROM {table})\
+    '''
+    select_from_dual = '''\
+        SELECT {columns} FROM DUAL\
+    '''
+    get_columns_from = '''\
+        SELECT {columns} FROM {table}\
+    '''
     get_all_from_uniq = '''\
         SELECT * FROM {table} t
         WHERE NOT EXISTS (
             SELECT null FROM {table} t1
             WHERE 
     '''
+    order_by = '''
+        ORDER BY {ord}\
+    '''
     first_N_only = '''
         ORDER BY {ord}
         FETCH FIRST {N} ROWS ONLY\
@@ -96,6 +230,40 @@ class OracleSQLQueries():
         OFFSET {O} ROWS
         FETCH NEXT {N} ROWS ONLY\
     '''
+    get_max = '''\
+        SELECT MAX({col}) FROM {table}\
+    '''
+    get_database = '''\
+        SELECT SYS_CONTEXT('USERENV', 'DB_NAME') FROM DUAL\
+    '''
+    get_columns_from_at_or_above_mark = '''\
+        SELECT {columns} FROM {table} WHERE {col} >= :mark\
+    '''
+    get_fingerprints = '''\
+        SELECT {keys}, {hashes} FROM ({sub})\
+    '''
+    hash_hashes = '''\
+        STANDARD_HASH({hashes}, 'MD5')\
+    '''
+    hash_column = '''\
+        NVL(STANDARD_HASH({col}, 'MD5'), HEXTORAW('{null}'))\
+    '''
+    select_from_where = '''\
+        SELECT * FROM ({sub}) WHERE {cond}\
+    '''
+    hash_partition = '''\
+        ORA_HASH({cols}, {max}) = :p\
+    '''
+    ping = '''\
+        SELECT 1 FROM DUAL\
+    '''
+    set_binary_sort = '''\
+        ALTER SESSION SET NLS_SORT = BINARY\
+    '''
+    set_date_format = '''\
+        ALTER SESSION SET NLS_DATE_FORMAT = '{fmt}'
+                          NLS_TIMESTAMP_FORMAT = '{fmt}'\
+    '''
 
 class PostgreSQLQueries():
     '''Namespace for format()-able PostgreSQL queries.'''
@@ -105,9 +273,67 @@ class PostgreSQLQueries():
     select_all_from_where_eq = '''\
         SELECT * FROM {table} WHERE {col} = '{name}'\
     '''
+    select_above_id = '''\
+        SELECT {columns} FROM {table} WHERE {id} > {max}\
+    '''
+    select_max_id = '''\
+        SELECT coalesce(max({id}), 0) FROM {table}\
+    '''
+    stockprop_pairs = '''\
+        SELECT DISTINCT stock_id, type_id FROM stockprop
+            WHERE type_id IN ({ids})\
+    '''
+    create_stage_table = '''\
+        CREATE TEMP TABLE IF NOT EXISTS {table} (k text)\
+    '''
+    truncate = '''\
+        TRUNCATE {table}\
+    '''
+    analyze = '''\
+        ANALYZE {table}\
+    '''
+    drop_table = '''\
+        DROP TABLE IF EXISTS {table}\
+    '''
+    staged_stocks = '''\
+        SELECT s.{col}, s.stock_id FROM stock s
+            WHERE s.{col} IN (SELECT k FROM {stage})\
+    '''
+    staged_stockprops = '''\
+        SELECT p.stock_id, p.type_id FROM stockprop p
+            JOIN stock s ON s.stock_id = p.stock_id
+            WHERE s.name IN (SELECT k FROM {stage})\
+    '''
+    stockprop_types = '''\
+        SELECT c.name, c.cvterm_id FROM cvterm c
+            WHERE c.name = ANY(%s)
+                AND EXISTS (SELECT 1 FROM stockprop p
+                            WHERE p.type_id = c.cvterm_id)\
+    '''
+    select_phenotypes_in = '''\
+        SELECT uniquename FROM phenotype WHERE uniquename = ANY(%s)\
+    '''
+    staged_new_phenotypes = '''\
+        SELECT DISTINCT s.k FROM {stage} s
+            WHERE NOT EXISTS (SELECT 1 FROM phenotype p
+                              WHERE p.uniquename = s.k)\
+    '''
+    select_cvterm_names = '''\
+        SELECT cvterm_id, name FROM cvterm WHERE cvterm_id IN ({ids})\
+    '''
     select_count = '''\
         SELECT count(*) FROM {table}\
     '''
+    select_count_above_id = '''\
+        SELECT count(*) FROM {table} WHERE {id} > {max}\
+    '''
+    select_relation = '''\
+        SELECT oid, relfilenode FROM pg_class WHERE oid = %s::regclass\
+    '''
+    select_estimated_count = '''\
+        SELECT greatest(reltuples, 0)::bigint FROM pg_class
+            WHERE oid = %s::regclass\
+    '''
     insert_into_table = '''\
         INSERT INTO {table} {columns} VALUES {values}\
     '''
@@ -138,7 +364,9 @@ class PostgreSQLQueries():
 class VerboseQuiet(object):
     '''To be inherited from.'''
     def __init__(self):
-        self.printlock = threading.Lock()
+        # not threading.Lock(), as we also print from the OS thread of
+        # prefetch(), see os_lock()
+        self.printlock = os_lock()
         self.VERBOSE = False
         self.QUIET = False
     def __acq(self):
@@ -221,17 +449,29 @@ class Task(VerboseQuiet):
 
         Realistically we can only parallelize stocks and sites and contacts.
             => ([stocks, sites, ?], phenotypes)
+
+        If any task fails, the first exception is re-raised once all threads
+        of its list() are done.
         '''
         if type(tasks) == tuple:
             for t in tasks:
                 Task.parallel_upload(t)
         elif type(tasks) == list:
+            errors = []
+            def upload(task):
+                try:
+                    Task.parallel_upload(task)
+                except Exception:
+                    errors.append(sys.exc_info())
             ts = []
             for task in tasks:
-                t = threading.Thread(target=Task.parallel_upload, args=[task])
+                t = threading.Thread(target=upload, args=[task])
                 ts.append(t)
             map(lambda x: x.start(), ts)
             map(lambda x: x.join(), ts)
+            if errors:
+                etype, value, tb = errors[0]
+                raise etype, value, tb
         else:
             tasks.execute(thread=True)
 
@@ -247,20 +487,84 @@ class Task(VerboseQuiet):
         if ind: return pre + '\t'
         else:   return pre
 
+def os_lock():
+    '''Returns a lock of the real OS threads, see parallel_map(). After
+    monkey.patch_all() threading.Lock() only works between greenlets.'''
+    return monkey.get_original('thread', 'allocate_lock')()
+
+def parallel_map(f, items, workers=None):
+    '''map(f, items), but in real OS threads, the results keep their order.
+
+    Note that after monkey.patch_all() a threading.Thread is a greenlet, which
+    does not run blocking C-library calls (e.g. cx_Oracle) concurrently.
+    '''
+    items = list(items)
+    if not items:
+        return []
+    pool = ThreadPool(workers or len(items))
+    try:
+        return pool.map(f, items)
+    finally:
+        pool.kill()
+
+def prefetch(iterable, depth=1):
+    '''Generator over <iterable>, which already pulls up to <depth> items
+    ahead, in a real OS thread, see parallel_map(). Thus at most <depth> + 1
+    items are in memory at once.
+
+    <iterable> is only ever advanced by that one thread, so it might be a
+    generator. Exceptions it raises are re-raised here, in order.
+    If we stop early, we wait for the item being fetched, but don't start
+    another, so <iterable> is idle once we return, and its resources (e.g.
+    a cursor) may be used again.
+    '''
+    it = iter(iterable)
+    if depth < 1:
+        for item in it:
+            yield item
+        return
+    stop = [False]
+    def step():
+        if stop[0]:
+            return False, None
+        try:
+            return True, next(it)
+        except StopIteration:
+            return False, None
+    pool = ThreadPool(1)
+    pending = deque()
+    try:
+        pending.extend(pool.spawn(step) for _ in range(depth))
+        while True:
+            more, item = pending.popleft().get()
+            if not more:
+                return
+            pending.append(pool.spawn(step))
+            yield item
+    finally:
+        stop[0] = True
+        for result in pending:
+            try:
+                result.get()
+            except Exception:
+                pass # we are leaving anyway
+        pool.kill()
+
 def uniq(l, key=None):
     'uniq(iterable, key=None) --> new list with unique entries'
-    if not key:
-        r = []
-        for i in l:
-            if not i in r:
-                r.append(i)
-        return r
-    else:
-        keyed_list = []
-        unkeyed_list = []
-        for i in l:
-            keyed_i = key(i)
-            if not keyed_i in keyed_list:
-                keyed_list.append(keyed_i)
-                unkeyed_list.append(i)
-        return unkeyed_list
+    r = []
+    seen = set()
+    unhashable = [] # e.g. lists or dicts with unhashable values
+    for i in l:
+        k = key(i) if key else i
+        try:
+            h = frozenset(k.iteritems()) if type(k) is dict else k
+            if h in seen:
+                continue
+            seen.add(h)
+        except TypeError:
+            if k in unhashable:
+                continue
+            unhashable.append(k)
+        r.append(i)
+    return r